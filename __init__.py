@@ -12,8 +12,9 @@ from .list_entry_widget import FloatListWidget
 from .notify import Notipy
 from .scientific_spinbox import ScienSpinBox, ScienDSpinBox
 from .settings_pane import SettingsWidget
-from .dark_mode_support import isDarkWindow, LINE_COLOR_DARK, LINE_COLOR_LIGHT
+from .dark_mode_support import isDarkWindow, ThemeMonitor, LINE_COLOR_DARK, LINE_COLOR_LIGHT
 from .connection_dialog import ConnectionDialog
 from .spinner import QProgressIndicator
 from .animated_widgets import AnimatedResizeWidget, AnimatedStackedWidget, FaderWidget
-from .misc import get_scaled_font, elide_string, get_masked_image
+from .frame_profiler import FrameProfiler
+from .misc import get_scaled_font, elide_string, elide_strings, get_masked_image
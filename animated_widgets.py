@@ -7,43 +7,82 @@
 Attribution-NonCommercial-NoDerivs 2.0 UK: England & Wales License.
 
 """
+import collections
+
 # external packages
-from PyQt5 import QtCore, QtWidgets
+from PyQt5 import QtCore, QtGui, QtWidgets, sip
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPainter, QPixmap, QWindow
+from PyQt5.QtGui import QPainter, QPixmap
+
+from .frame_profiler import FrameProfiler
 
 
 class FaderWidget(QtWidgets.QWidget):
+    """
+    A widget which covers *new_widget* with a snapshot of *old_widget* and fades it
+    out. Repaints are scheduled with ``update()`` and the snapshot can be passed in as
+    *old_pixmap* to avoid rendering the old widget again.
+    """
 
     pixmap_opacity = 1.0
 
-    def __init__(self, old_widget, new_widget, duration=300):
+    def __init__(self, old_widget, new_widget, duration=300, old_pixmap=None):
         QtWidgets.QWidget.__init__(self, new_widget)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+
+        if old_pixmap is None:
+            old_pixmap = self.snapshot(old_widget)
 
-        pr = QWindow().devicePixelRatio()
-        self.old_pixmap = QPixmap(new_widget.size()*pr)
-        self.old_pixmap.setDevicePixelRatio(pr)
-        old_widget.render(self.old_pixmap)
+        self.old_pixmap = old_pixmap
 
         self.timeline = QtCore.QTimeLine()
+        self.timeline.setUpdateInterval(16)
         self.timeline.valueChanged.connect(self.animate)
-        self.timeline.finished.connect(self.close)
+        self.timeline.finished.connect(self._on_finished)
         self.timeline.setDuration(duration)
+        FrameProfiler.instance().startAnimation(self, interval=16)
         self.timeline.start()
 
-        self.resize(new_widget.size())
+        self.resize(old_widget.size())
         self.show()
 
+    @staticmethod
+    def snapshot(widget):
+        """Renders *widget* into a pixmap at the screen's pixel ratio."""
+        pr = widget.devicePixelRatioF()
+        pixmap = QPixmap(widget.size()*pr)
+        pixmap.setDevicePixelRatio(pr)
+        widget.render(pixmap)
+        return pixmap
+
     def paintEvent(self, event):
+        profiler = FrameProfiler.instance()
+        start = profiler.now() if profiler.enabled else None
+
         painter = QPainter()
         painter.begin(self)
         painter.setOpacity(self.pixmap_opacity)
         painter.drawPixmap(0, 0, self.old_pixmap)
         painter.end()
 
+        if start is not None:
+            profiler.recordPaint(self, start)
+
     def animate(self, value):
         self.pixmap_opacity = 1.0 - value
-        self.repaint()
+        self.update()
+        FrameProfiler.instance().recordFrame(self)
+
+    def stop(self):
+        """Stops the fade immediately and removes the widget."""
+        self.timeline.stop()
+        self._on_finished()
+
+    @QtCore.pyqtSlot()
+    def _on_finished(self):
+        FrameProfiler.instance().finishAnimation(self)
+        self.close()
 
 
 class AnimatedStackedWidget(QtWidgets.QStackedWidget):
@@ -51,6 +90,9 @@ class AnimatedStackedWidget(QtWidgets.QStackedWidget):
     A subclass of ``QStackedWidget`` with sliding or fading animations between stacks.
     """
 
+    QueueTransitions = 0
+    RetargetTransitions = 1
+
     def __init__(self, parent=None):
         super(AnimatedStackedWidget, self).__init__(parent)
 
@@ -61,8 +103,34 @@ class AnimatedStackedWidget(QtWidgets.QStackedWidget):
         self.m_next = 0
         self.m_wrap = False
         self.m_pnow = QtCore.QPoint(0, 0)
+        self.m_pnext = QtCore.QPoint(0, 0)
         self.m_active = False
 
+        # slide animations are allocated once and reused for every transition
+        self.m_animGroup = QtCore.QParallelAnimationGroup(self)
+        self.m_animNow = QtCore.QPropertyAnimation(self.m_animGroup)
+        self.m_animNext = QtCore.QPropertyAnimation(self.m_animGroup)
+        self.m_animNow.setPropertyName(b"pos")
+        self.m_animNext.setPropertyName(b"pos")
+        self.m_animGroup.finished.connect(self.animationDoneSlot)
+        self.m_animNext.valueChanged.connect(self._on_animation_frame)
+        self.m_transitionPolicy = self.QueueTransitions
+        self.m_pending = collections.deque()
+
+        self.fader_widget = None
+
+        # lazily constructed pages: factories of pages which have not been built yet,
+        # keyed by their placeholder, and built pages in least recently used order
+        self.m_placeholders = {}
+        self.m_lazy_pages = collections.OrderedDict()
+        self.m_evictionTimeout = None
+        self.m_maxLoadedPages = None
+        self.m_evictionTimer = QtCore.QTimer(self)
+        self.m_evictionTimer.timeout.connect(self.evictIdlePages)
+        self.m_lastCurrent = None
+
+        self.currentChanged.connect(self._on_current_changed)
+
     def setDirection(self, direction):
         self.m_direction = direction
 
@@ -75,15 +143,151 @@ class AnimatedStackedWidget(QtWidgets.QStackedWidget):
     def setWrap(self, wrap):
         self.m_wrap = wrap
 
+    def setEvictionTimeout(self, msecs):
+        """
+        Sets the time in ms after which lazily constructed pages which are not shown
+        are deleted again. They will be rebuilt from their factory when needed. Set to
+        ``None`` to keep pages indefinitely (default).
+        """
+        self.m_evictionTimeout = msecs
+        if msecs is None:
+            self.m_evictionTimer.stop()
+        else:
+            self.m_evictionTimer.start(msecs)
+
+    def setMaxLoadedPages(self, count):
+        """
+        Sets the maximum number of lazily constructed pages to keep alive. Least
+        recently used pages are evicted first. Set to ``None`` for no limit (default).
+        """
+        self.m_maxLoadedPages = count
+        self.evictIdlePages()
+
+    def addLazyWidget(self, factory):
+        """
+        Adds a page which will only be constructed by calling *factory* when it is
+        first shown.
+
+        :param factory: Callable which takes no arguments and returns a ``QWidget``.
+        :return: Index of the page.
+        """
+        return self.insertLazyWidget(self.count(), factory)
+
+    def insertLazyWidget(self, index, factory):
+        """
+        Inserts a page at *index* which will only be constructed by calling *factory*
+        when it is first shown.
+
+        :param int index: Position of the page.
+        :param factory: Callable which takes no arguments and returns a ``QWidget``.
+        :return: Index of the page.
+        """
+        placeholder = QtWidgets.QWidget()
+        self.m_placeholders[placeholder] = factory
+        return self.insertWidget(index, placeholder)
+
+    def isPageLoaded(self, index):
+        """Returns ``False`` if the page at *index* has not been constructed yet."""
+        return self.widget(index) not in self.m_placeholders
+
+    def loadPage(self, index):
+        """
+        Constructs the page at *index* if it was added lazily and returns it.
+
+        :param int index: Index of the page.
+        :return: The page widget.
+        """
+        widget = self.widget(index)
+        factory = self.m_placeholders.pop(widget, None)
+
+        if factory is None:
+            return widget
+
+        page = factory()
+        self._replacePage(index, widget, page)
+        self.m_lazy_pages[page] = (factory, self._idleTimer())
+        self._evictPages(keep=(page,))
+
+        return page
+
+    @QtCore.pyqtSlot()
+    def evictIdlePages(self):
+        """
+        Deletes lazily constructed pages which have been hidden for longer than the
+        eviction timeout or which exceed the maximum number of loaded pages.
+        """
+        self._evictPages()
+
+    def _evictPages(self, keep=()):
+        # never evict the current page, pages of a running or queued slide or the
+        # pages given in keep
+        busy = (self.currentWidget(),) + tuple(keep)
+        busy += tuple(self.widget(index) for index in self.m_pending)
+
+        if self.m_active:
+            busy += (self.widget(self.m_now), self.widget(self.m_next))
+
+        candidates = [p for p in self.m_lazy_pages if p not in busy]
+        excess = 0
+
+        if self.m_maxLoadedPages is not None:
+            excess = len(self.m_lazy_pages) - self.m_maxLoadedPages
+
+        for page in candidates:
+            factory, idle = self.m_lazy_pages[page]
+            expired = (self.m_evictionTimeout is not None and
+                       idle.hasExpired(self.m_evictionTimeout))
+            if excess > 0 or expired:
+                self._evictPage(page)
+                excess -= 1
+
+    def _evictPage(self, page):
+        factory, _ = self.m_lazy_pages.pop(page)
+        placeholder = QtWidgets.QWidget()
+        self.m_placeholders[placeholder] = factory
+        self._replacePage(self.indexOf(page), page, placeholder)
+
+    def _replacePage(self, index, old, new):
+        current = self.currentIndex()
+
+        self.blockSignals(True)
+        self.removeWidget(old)
+        self.insertWidget(index, new)
+        self.setCurrentIndex(current)
+        self.blockSignals(False)
+
+        old.deleteLater()
+
+    @staticmethod
+    def _idleTimer():
+        timer = QtCore.QElapsedTimer()
+        timer.start()
+        return timer
+
+    def _touch(self, page):
+        # move page to the end of the LRU order and restart its idle time
+        if page in self.m_lazy_pages:
+            factory, _ = self.m_lazy_pages.pop(page)
+            self.m_lazy_pages[page] = (factory, self._idleTimer())
+
+    @QtCore.pyqtSlot(int)
+    def _on_current_changed(self, index):
+        if index >= 0 and not self.isPageLoaded(index):
+            self.loadPage(index)
+
+        self._touch(self.m_lastCurrent)
+        self._touch(self.currentWidget())
+        self.m_lastCurrent = self.currentWidget()
+
     @QtCore.pyqtSlot()
     def slideInPrev(self):
-        now = self.currentIndex()
+        now = self._targetIndex()
         if self.m_wrap or now > 0:
             self.slideInIdx(now - 1)
 
     @QtCore.pyqtSlot()
     def slideInNext(self):
-        now = self.currentIndex()
+        now = self._targetIndex()
         if self.m_wrap or now < (self.count() - 1):
             self.slideInIdx(now + 1)
 
@@ -92,19 +296,30 @@ class AnimatedStackedWidget(QtWidgets.QStackedWidget):
             idx = idx % self.count()
         elif idx < 0:
             idx = (idx + self.count()) % self.count()
-        self.slideInWgt(self.widget(idx))
+        self.slideInWgt(self.loadPage(idx))
 
     def slideInWgt(self, newwidget):
+        _next = self.indexOf(newwidget)
+
         if self.m_active:
+            if self.m_transitionPolicy == self.RetargetTransitions:
+                # jump to the end of the running slide and continue from there
+                self.m_pending.clear()
+                self.m_pending.append(_next)
+                self.m_animGroup.stop()
+                self.animationDoneSlot()
+            else:
+                self.m_pending.append(_next)
             return
 
         self.m_active = True
 
         _now = self.currentIndex()
-        _next = self.indexOf(newwidget)
+        self.loadPage(_next)
 
         if _now == _next:
             self.m_active = False
+            self._startPending()
             return
 
         offsetx, offsety = self.frameRect().width(), self.frameRect().height()
@@ -124,46 +339,101 @@ class AnimatedStackedWidget(QtWidgets.QStackedWidget):
         pnext = self.widget(_next).pos()
         pnow = self.widget(_now).pos()
         self.m_pnow = pnow
+        self.m_pnext = pnext
 
         offset = QtCore.QPoint(offsetx, offsety)
         self.widget(_next).move(pnext - offset)
         self.widget(_next).show()
         self.widget(_next).raise_()
 
-        anim_group = QtCore.QParallelAnimationGroup(
-            self, finished=self.animationDoneSlot
-        )
-
-        for index, start, end in zip((_now, _next), (pnow, pnext - offset), (pnow + offset, pnext)):
-            animation = QtCore.QPropertyAnimation(
-                self.widget(index),
-                b"pos",
-                duration=self.m_speed,
-                easingCurve=self.m_animationtype,
-                startValue=start,
-                endValue=end,
-            )
-            anim_group.addAnimation(animation)
+        for animation, index, start, end in zip(
+                (self.m_animNow, self.m_animNext), (_now, _next),
+                (pnow, pnext - offset), (pnow + offset, pnext)):
+            animation.setTargetObject(self.widget(index))
+            animation.setDuration(self.m_speed)
+            animation.setEasingCurve(self.m_animationtype)
+            animation.setStartValue(start)
+            animation.setEndValue(end)
 
         self.m_next = _next
         self.m_now = _now
         self.m_active = True
-        anim_group.start(QtCore.QAbstractAnimation.DeleteWhenStopped)
+        FrameProfiler.instance().startAnimation(self, "slide")
+        self.m_animGroup.start()
 
     @QtCore.pyqtSlot()
     def animationDoneSlot(self):
+        FrameProfiler.instance().finishAnimation(self, "slide")
         self.setCurrentIndex(self.m_next)
+        self.widget(self.m_next).move(self.m_pnext)
         self.widget(self.m_now).hide()
         self.widget(self.m_now).move(self.m_pnow)
         self.m_active = False
+        self._startPending()
+
+    def setTransitionPolicy(self, policy):
+        """
+        Sets how slide requests are handled while a slide is running.
+        :attr:`QueueTransitions` (default) performs all requested slides in order,
+        :attr:`RetargetTransitions` finishes the running slide immediately and slides
+        to the latest requested page.
+        """
+        self.m_transitionPolicy = policy
+
+    def lastFrameTimes(self):
+        """
+        Returns the intervals in ms between animation frames of the last slide. Large
+        values indicate dropped frames. Frames are only recorded while the
+        :class:`FrameProfiler` is enabled.
+        """
+        return FrameProfiler.instance().frameIntervals(self, "slide")
+
+    @QtCore.pyqtSlot()
+    def _on_animation_frame(self):
+        FrameProfiler.instance().recordFrame(self, "slide")
+
+    def _startPending(self):
+        if self.m_pending:
+            self.slideInIdx(self.m_pending.popleft())
+
+    def _targetIndex(self):
+        # the page which will be shown once all running and queued slides are done
+        if self.m_pending:
+            return self.m_pending[-1]
+        elif self.m_active:
+            return self.m_next
+        else:
+            return self.currentIndex()
 
     def fadeInIdx(self, index):
-        self.fader_widget = FaderWidget(self.currentWidget(), self.widget(index),
-                                        self.m_speed)
+        if self.fader_widget and not sip.isdeleted(self.fader_widget):
+            self.fader_widget.stop()
+
+        old_widget = self.currentWidget()
+        new_widget = self.loadPage(index)
+
+        # the outgoing page may show live content, always take a fresh snapshot
+        self.fader_widget = FaderWidget(old_widget, new_widget, self.m_speed)
         self.setCurrentIndex(index)
 
 
 class AnimatedResizeWidget(QtWidgets.QWidget):
+    """
+    A ``QWidget`` which animates changes of its geometry, including those requested by
+    ``adjustSize``. Resizes to the current geometry are skipped. The adjusted size is
+    cached until the layout is invalidated, the style or font change or the widget
+    moves to a different screen.
+    """
+
+    animation = None
+    _layoutGeneration = 0
+    _adjustedSizeCache = (None, None)
+
+    def event(self, event):
+        if event.type() in (QtCore.QEvent.LayoutRequest, QtCore.QEvent.StyleChange,
+                            QtCore.QEvent.FontChange):
+            self._layoutGeneration += 1
+        return QtWidgets.QWidget.event(self, event)
 
     def adjustSize(self):
         self.animatedResize()
@@ -174,16 +444,48 @@ class AnimatedResizeWidget(QtWidgets.QWidget):
             newSize = self._adjustedSize()
             newGeometry = QtCore.QRect(currentGeometry.topLeft(), newSize)
 
-        self.animation = QtCore.QPropertyAnimation(self, b"geometry")
+        if self.animation is None:
+            self.animation = QtCore.QPropertyAnimation(self, b"geometry", self)
+            self.animation.valueChanged.connect(self._on_animation_frame)
+            self.animation.finished.connect(self._on_animation_finished)
+
+        if self.animation.state() == QtCore.QAbstractAnimation.Running:
+            if self.animation.endValue() == newGeometry:
+                return
+            self.animation.stop()
+        elif currentGeometry == newGeometry:
+            return
+
         self.animation.setDuration(ms_time)
         self.animation.setStartValue(currentGeometry)
         self.animation.setEndValue(newGeometry)
+        FrameProfiler.instance().startAnimation(self, "resize")
         self.animation.start()
 
+    @QtCore.pyqtSlot()
+    def _on_animation_frame(self):
+        FrameProfiler.instance().recordFrame(self, "resize")
+
+    @QtCore.pyqtSlot()
+    def _on_animation_finished(self):
+        FrameProfiler.instance().finishAnimation(self, "resize")
+
     def _adjustedSize(self):
 
         s = self.sizeHint()
 
+        # Layout requests are posted events, include the size hint to catch changes
+        # which have not been delivered yet.
+        policy = self.sizePolicy()
+        screen = self._screenGeometry() if self.isWindow() else None
+        key = (self._layoutGeneration, s.width(), s.height(), screen and screen.getRect(),
+               int(policy.horizontalPolicy()), int(policy.verticalPolicy()),
+               policy.hasHeightForWidth())
+
+        cached_key, cached_size = self._adjustedSizeCache
+        if key == cached_key:
+            return QtCore.QSize(cached_size)
+
         if self.isWindow():
             layout = self.layout()
 
@@ -201,15 +503,25 @@ class AnimatedResizeWidget(QtWidgets.QWidget):
             if int(exp) & QtCore.Qt.Vertical:
                 s.setHeight(max(s.height(), 100))
 
-            screen = QtWidgets.QDesktopWidget().screenGeometry(self.pos())
-
-            s.setWidth(min(s.width(), screen.width()*2/3))
-            s.setHeight(min(s.height(), screen.height()*2/3))
+            s.setWidth(min(s.width(), int(screen.width()*2/3)))
+            s.setHeight(min(s.height(), int(screen.height()*2/3)))
 
         if not s.isValid():
-            r = self.childrenRect()
-            if r.isNull():
-                return r
-            s = r.size() + QtCore.QSize(2 * r.x(), 2 * r.y())
+            # depends on the geometry of the children, not cached
+            return self._childrenSize()
+
+        self._adjustedSizeCache = (key, QtCore.QSize(s))
 
         return s
+
+    def _childrenSize(self):
+        r = self.childrenRect()
+        if r.isNull():
+            return r.size()
+        return r.size() + QtCore.QSize(2 * r.x(), 2 * r.y())
+
+    def _screenGeometry(self):
+        screen = QtGui.QGuiApplication.screenAt(self.pos())
+        if screen is None:
+            screen = QtGui.QGuiApplication.primaryScreen()
+        return screen.geometry()
@@ -0,0 +1,124 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Sam Schott  (ss2151@cam.ac.uk)
+
+(c) Sam Schott; This work is licensed under a Creative Commons
+Attribution-NonCommercial-NoDerivs 2.0 UK: England & Wales License.
+
+Integration of asyncio with the Qt event loop. If the application already runs an
+asyncio event loop on top of Qt, for instance with qasync, coroutines are scheduled on
+that loop. Otherwise, a private asyncio event loop is pumped from a ``QTimer`` in the
+GUI thread. In both cases, coroutines run in the GUI thread and may update widgets.
+
+"""
+import asyncio
+
+# external packages
+from PyQt5 import QtCore
+
+from .misc import BackgroundTask, get_thread_pool
+
+
+class QtAsyncioBridge(QtCore.QObject):
+    """
+    Runs an asyncio event loop on the Qt event loop by processing all ready asyncio
+    callbacks and I/O events every *interval* ms. Use :meth:`instance` to get the
+    process-wide bridge.
+    """
+
+    _instance = None
+
+    def __init__(self, interval=5):
+        QtCore.QObject.__init__(self, QtCore.QCoreApplication.instance())
+
+        self.loop = asyncio.new_event_loop()
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self._pump)
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def create_task(self, coro):
+        """Schedules a coroutine on the bridged loop and returns an ``asyncio.Task``."""
+        task = self.loop.create_task(coro)
+        task.add_done_callback(self._on_task_done)
+        self._timer.start()
+        return task
+
+    @QtCore.pyqtSlot()
+    def _pump(self):
+        # run a single iteration of the asyncio loop
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    def _on_task_done(self, task):
+        if not asyncio.all_tasks(self.loop):
+            self._timer.stop()
+
+
+def get_running_loop():
+    """
+    Returns the running asyncio event loop if there is one, for instance a qasync
+    loop, and the loop of :class:`QtAsyncioBridge` otherwise.
+    """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return QtAsyncioBridge.instance().loop
+
+
+def run_coroutine(coro):
+    """
+    Runs a coroutine on the Qt event loop without blocking.
+
+    :param coro: Coroutine to run.
+    :return: ``asyncio.Task`` wrapping the coroutine.
+    """
+    try:
+        return asyncio.get_running_loop().create_task(coro)
+    except RuntimeError:
+        return QtAsyncioBridge.instance().create_task(coro)
+
+
+async def run_in_background(target, *args, pool=None, timeout=None, with_token=False,
+                            **kwargs):
+    """
+    Runs *target* in a :class:`misc.BackgroundTask` and waits for its result without
+    blocking the event loop. If the awaiting coroutine is cancelled, the task is
+    cancelled as well.
+
+    :param target: Callable to run in the background.
+    :param args: Positional arguments for *target*.
+    :param pool: ``QThreadPool`` to run in. Defaults to the shared pool from
+        :func:`misc.get_thread_pool`.
+    :param int timeout: Optional timeout in ms after which the task is cancelled.
+    :param bool with_token: If ``True``, a :class:`misc.CancellationToken` is passed to
+        *target* as keyword argument ``token``.
+    :param kwargs: Keyword arguments for *target*.
+    :return: Return value of *target*.
+    """
+    if pool is None:
+        pool = get_thread_pool()
+
+    task = BackgroundTask(target=target, args=args, kwargs=kwargs, pool=pool,
+                          timeout=timeout, with_token=with_token)
+
+    try:
+        return await task.future
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+
+async def wait_for_task(task):
+    """
+    Waits for an already started :class:`misc.BackgroundTask` without blocking the
+    event loop and returns its result.
+    """
+    return await task.future
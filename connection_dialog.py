@@ -7,13 +7,27 @@
 Attribution-NonCommercial-NoDerivs 2.0 UK: England & Wales License.
 
 """
+import logging
 import os.path as osp
+import time
+import weakref
 import pyvisa
-from PyQt5 import QtCore, QtWidgets, uic
+from PyQt5 import QtCore, QtWidgets, sip, uic
+
+from .misc import BackgroundTask, TaskFuture, get_thread_pool
+from .spinner import QProgressIndicator
 
 basedir = osp.dirname(osp.abspath(__file__))
 CONNECTION_UI_PATH = osp.join(basedir, 'connection_dialog.ui')
 
+logger = logging.getLogger(__name__)
+
+# time in sec for which found resources are reused
+RESOURCE_CACHE_TTL = 60
+
+# found resources per ResourceManager as (timestamp, resources)
+_resource_cache = weakref.WeakKeyDictionary()
+
 
 class ConnectionDialog(QtWidgets.QDialog):
     """
@@ -26,8 +40,19 @@ class ConnectionDialog(QtWidgets.QDialog):
 
     If a config instance `conf` is given, it is used to store the Visa library and
     address.
+
+    Instrument addresses are searched in the background and cached for
+    :data:`RESOURCE_CACHE_TTL` sec per resource manager. Each query in
+    :attr:`RESOURCE_QUERIES` runs in parallel and its results are added when it
+    completes. With the default single query, all addresses are therefore added at
+    once. With NI-VISA, queries per interface, e.g., ``'USB?*::INSTR'`` and
+    ``'GPIB?*::INSTR'``, let fast interfaces show up before slow ones. This is not
+    recommended with pyvisa-py which enumerates all interfaces for every query.
+    Failed searches are logged.
     """
 
+    RESOURCE_QUERIES = ('?*::INSTR',)
+
     def __init__(self, parent, instr, conf=None):
         super(self.__class__, self).__init__(parent=parent)
         # load user interface layout from .ui file
@@ -36,6 +61,13 @@ class ConnectionDialog(QtWidgets.QDialog):
         self.instr = instr
         self.conf = conf
 
+        # spinner in place of the search button while searching
+        self._search_id = 0
+        self._running_searches = set()
+        self.spinner = QProgressIndicator(self)
+        self.spinner.hide()
+        self.layout().addWidget(self.spinner, 3, 2, QtCore.Qt.AlignCenter)
+
         # populate UI
         self.populate_ui_from_instr()
 
@@ -54,7 +86,7 @@ class ConnectionDialog(QtWidgets.QDialog):
         is_auto = self.instr.visa_library == ''
         self.checkBoxAutoVisa.setChecked(is_auto)
         self._on_auto_checked(is_auto)
-        self._on_search_clicked()  # search for instrument addresses
+        self.search_async()  # search for instrument addresses
 
     @QtCore.pyqtSlot(bool)
     def _on_auto_checked(self, checked):
@@ -83,22 +115,149 @@ class ConnectionDialog(QtWidgets.QDialog):
 
     @QtCore.pyqtSlot()
     def _on_search_clicked(self):
+        self.search_async(refresh=True).add_done_callback(self._on_search_done)
+
+    def _on_search_done(self, future):
+        if future.exception() is not None:
+            QtWidgets.QMessageBox.warning(
+                self, 'error', 'Could not search for instruments:\n%s' % future.exception())
+
+    def _populate_addresses(self, resources):
         # set Address comboBox status
         self.comboBoxAddress.clear()
         self.comboBoxAddress.addItems([self.instr.visa_address])
-        self.comboBoxAddress.addItems(self.instr.rm.list_resources())
+        self._add_addresses(resources)
         self.comboBoxAddress.setCurrentIndex(0)
 
+    def _add_addresses(self, resources):
+        # adds new addresses without changing the current selection or text
+        for address in resources:
+            if self.comboBoxAddress.findText(address) == -1:
+                self.comboBoxAddress.addItem(address)
+
     @QtCore.pyqtSlot()
     def _on_accept(self):
         """ Update connection settings, reconnect with new settings."""
-        self.instr.visa_library = self.lineEditLibrary.text()
+        searches = self._cancel_search()
+        library = self._store_settings()
+        self._on_reconnected(self._reconnect(searches), library)
+
+    def search_async(self, refresh=False):
+        """
+        Searches for instrument addresses in the background and adds them to the UI as
+        they are found. Cached results are used if they are younger than
+        :data:`RESOURCE_CACHE_TTL` sec, unless *refresh* is ``True``.
+
+        :param bool refresh: Ignore cached results.
+        :return: Awaitable :class:`misc.TaskFuture` with the found resources.
+        """
+        rm = self.instr.rm
+        future = TaskFuture()
+
+        self._search_id += 1
+        search_id = self._search_id
+
+        self._populate_addresses([])
+
+        cached = _resource_cache.get(rm)
+
+        if not refresh and cached and time.monotonic() - cached[0] < RESOURCE_CACHE_TTL:
+            self._add_addresses(cached[1])
+            self._set_searching(False)
+            future.set_result(cached[1])
+            return future
+
+        self._set_searching(True)
+
+        found = []
+        errors = []
+        remaining = [len(self.RESOURCE_QUERIES)]
+
+        def is_current():
+            # the dialog may have been deleted while searching
+            return not sip.isdeleted(self) and search_id == self._search_id
+
+        def on_found(resources):
+            if is_current():
+                self._add_addresses(resources)
+
+        def on_done(f):
+            if f.exception() is not None:
+                errors.append(f.exception())
+                logger.error('Could not list VISA resources', exc_info=f.exception())
+            else:
+                found.extend(r for r in f.result() if r not in found)
+
+            remaining[0] -= 1
+
+            if remaining[0] == 0:
+                if is_current():
+                    self._set_searching(False)
+
+                if len(errors) == len(self.RESOURCE_QUERIES):
+                    future.set_exception(errors[-1])
+                else:
+                    _resource_cache[rm] = (time.monotonic(), tuple(found))
+                    future.set_result(tuple(found))
+
+        for query in self.RESOURCE_QUERIES:
+            # tasks are not owned by the dialog so that they may outlive it
+            task = BackgroundTask(target=rm.list_resources, args=(query,),
+                                  pool=get_thread_pool())
+            self._running_searches.add(task.future)
+            task.future.add_done_callback(self._running_searches.discard)
+            self._chain(task, on_found).add_done_callback(on_done)
+
+        return future
+
+    def _cancel_search(self):
+        # Results of running searches will be ignored. Returns the futures of running
+        # searches which must be waited for before the resource manager is closed.
+        self._search_id += 1
+        self._set_searching(False)
+        return list(self._running_searches)
+
+    def _set_searching(self, searching):
+        self.pushButtonSearch.setVisible(not searching)
+        self.spinner.setVisible(searching)
+        if searching:
+            self.spinner.startAnimation()
+        else:
+            self.spinner.stopAnimation()
+
+    def connect_async(self):
+        """
+        Stores the connection settings and reconnects the instrument in a background
+        thread.
+
+        :return: Awaitable :class:`misc.TaskFuture` which is done once reconnected.
+        """
+        searches = self._cancel_search()
+        library = self._store_settings()
+        task = BackgroundTask(target=self._reconnect, args=(searches,), pool=get_thread_pool())
+        return self._chain(task, lambda found: self._on_reconnected(found, library))
+
+    def _store_settings(self):
+        # returns the VISA library as entered by the user
+        library = self.lineEditLibrary.text()
+
+        self.instr.visa_library = library
         self.instr.visa_address = self.comboBoxAddress.currentText()
 
         self.conf.set('Connection', 'VISA_LIBRARY', self.instr.visa_library)
         self.conf.set('Connection', 'VISA_ADDRESS', self.instr.visa_address)
 
-        # reconnect with new address
+        return library
+
+    def _reconnect(self, searches=()):
+        """
+        Reconnects with the new address. Returns ``False`` if the VISA library was not
+        found and the default backend was used instead. Waits for the given searches to
+        finish before closing the resource manager. Does not touch the UI.
+        """
+        for search in searches:
+            search.wait()
+
         # close and reopen ResourceManager for visa_lib path change to take effect
         if self.instr.connected:
             self.instr.disconnect()
@@ -107,18 +266,41 @@ class ConnectionDialog(QtWidgets.QDialog):
 
         try:
             self.instr.rm = pyvisa.ResourceManager(self.instr.visa_library)
-
+            found = True
         except ValueError:
-            msg = ('Could not find backend %s.\n' % self.lineEditLibrary.text() +
-                   'Using default backend instead.')
-            QtWidgets.QMessageBox.information(self, str('error'), msg)
-
             self.instr.visa_library = ''
             self.instr.rm = pyvisa.ResourceManager()
+            found = False
+
+        self.instr.connect()
+
+        return found
+
+    def _on_reconnected(self, found, library):
+        if not found:
+            msg = ('Could not find backend %s.\n' % library +
+                   'Using default backend instead.')
+            QtWidgets.QMessageBox.information(self, str('error'), msg)
 
             self.populate_ui_from_instr()
 
-        self.instr.connect()
+    def _chain(self, task, callback):
+        # returns a future which completes after callback was called with the task's
+        # result in the GUI thread, the callback is skipped if the dialog was deleted
+        future = TaskFuture()
+
+        def on_done(f):
+            task.deleteLater()
+            if f.exception() is not None:
+                future.set_exception(f.exception())
+            else:
+                if not sip.isdeleted(self):
+                    callback(f.result())
+                future.set_result(f.result())
+
+        task.future.add_done_callback(on_done)
+
+        return future
 
     @QtCore.pyqtSlot()
     def _on_help_clicked(self):
@@ -7,7 +7,7 @@
 Attribution-NonCommercial-NoDerivs 2.0 UK: England & Wales License.
 
 """
-from PyQt5 import QtWidgets, QtGui
+from PyQt5 import QtCore, QtWidgets, QtGui
 
 
 THEME_DARK = "dark"
@@ -26,18 +26,99 @@ def rgb_to_luminance(r, g, b, base=256):
     return (0.2126*r + 0.7152*g + 0.0722*b)/base
 
 
+class _AppearanceProbe(QtWidgets.QWidget):
+    """A hidden widget which receives application-wide appearance change events."""
+
+    sig_palette_changed = QtCore.pyqtSignal()
+    sig_font_changed = QtCore.pyqtSignal()
+    sig_style_changed = QtCore.pyqtSignal()
+
+    def changeEvent(self, event):
+        if event.type() in (QtCore.QEvent.PaletteChange,
+                            QtCore.QEvent.ApplicationPaletteChange):
+            self.sig_palette_changed.emit()
+        elif event.type() in (QtCore.QEvent.FontChange,
+                              QtCore.QEvent.ApplicationFontChange):
+            self.sig_font_changed.emit()
+        elif event.type() == QtCore.QEvent.StyleChange:
+            self.sig_style_changed.emit()
+
+
+_probe = None
+
+
+def appearance_probe():
+    """
+    Returns a hidden widget which emits ``sig_palette_changed``, ``sig_font_changed``
+    and ``sig_style_changed`` when the application's palette, font or style changes.
+    """
+    global _probe
+
+    if _probe is None:
+        _probe = _AppearanceProbe()
+
+    return _probe
+
+
+class ThemeMonitor(QtCore.QObject):
+    """
+    Caches the current UI theme and emits :attr:`themeChanged` with the new theme
+    when the application palette switches between light and dark. Use
+    :meth:`instance` to get the process-wide monitor.
+    """
+
+    themeChanged = QtCore.pyqtSignal(str)
+
+    _instance = None
+
+    def __init__(self):
+        app = QtWidgets.QApplication.instance()
+        QtCore.QObject.__init__(self, app)
+
+        self._theme = None
+        self._probe = appearance_probe()
+        self._probe.sig_palette_changed.connect(self.invalidate)
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def theme(self):
+        """Returns the cached theme, THEME_LIGHT or THEME_DARK."""
+        if self._theme is None:
+            self._theme = self._detect_theme()
+        return self._theme
+
+    def isDark(self):
+        return self.theme() == THEME_DARK
+
+    @QtCore.pyqtSlot()
+    def invalidate(self):
+        """Discards the cached theme and emits :attr:`themeChanged` if it changed."""
+        old_theme = self._theme
+        self._theme = None
+
+        if old_theme is not None and self.theme() != old_theme:
+            self.themeChanged.emit(self._theme)
+
+    def _detect_theme(self):
+        # identify the best-fitting color theme based on the luminance of the
+        # window background color
+        bg_color = self._probe.palette().color(QtGui.QPalette.Background)
+        bg_color_rgb = [bg_color.red(), bg_color.green(), bg_color.blue()]
+        luminance = rgb_to_luminance(*bg_color_rgb)
+        return THEME_LIGHT if luminance >= 0.4 else THEME_DARK
+
+
 def windowTheme():
     """
     Returns one of gui.utils.THEME_LIGHT or gui.utils.THEME_DARK, corresponding to
-    current user's UI theme.
-    """
-    # getting color of a pixel on a top bar, and identifying best-fitting color
-    # theme based on its luminance
-    w = QtWidgets.QWidget()
-    bg_color = w.palette().color(QtGui.QPalette.Background)
-    bg_color_rgb = [bg_color.red(), bg_color.green(), bg_color.blue()]
-    luminance = rgb_to_luminance(*bg_color_rgb)
-    return THEME_LIGHT if luminance >= 0.4 else THEME_DARK
+    current user's UI theme. The result is cached until the application palette
+    changes.
+    """
+    return ThemeMonitor.instance().theme()
 
 
 def isDarkWindow():
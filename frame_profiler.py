@@ -0,0 +1,188 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Sam Schott  (ss2151@cam.ac.uk)
+
+(c) Sam Schott; This work is licensed under a Creative Commons
+Attribution-NonCommercial-NoDerivs 2.0 UK: England & Wales License.
+
+"""
+import collections
+import json
+
+# external packages
+from PyQt5 import QtCore
+
+
+# upper bounds in ms of the paint duration histogram bins
+PAINT_HISTOGRAM_BINS = (1, 2, 4, 8, 16, 33, 66, float("inf"))
+
+
+def profileKey(obj, animation=None):
+    """
+    Returns a readable key for an animated object, e.g., 'FaderWidget(0x7f...)' or
+    'AnimatedStackedWidget(pages).slide'.
+    """
+    key = "{}({})".format(type(obj).__name__, obj.objectName() or hex(id(obj)))
+    if animation:
+        key += "." + animation
+    return key
+
+
+class _AnimationStats(object):
+
+    def __init__(self, interval, max_frames):
+        self.interval = interval
+        self.timestamps = collections.deque(maxlen=max_frames)
+        self.paint_histogram = [0] * len(PAINT_HISTOGRAM_BINS)
+        self.frames = 0
+        self.janks = 0
+        self.max_interval = 0.0
+        self.last_frame = None
+
+    def frame(self, now, jank_factor):
+        if self.last_frame is not None:
+            interval = now - self.last_frame
+            self.max_interval = max(self.max_interval, interval)
+            if interval > self.interval * jank_factor:
+                self.janks += 1
+
+        self.last_frame = now
+        self.timestamps.append(now)
+        self.frames += 1
+
+    def paint(self, duration):
+        for i, upper in enumerate(PAINT_HISTOGRAM_BINS):
+            if duration <= upper:
+                self.paint_histogram[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            "interval": self.interval,
+            "frames": self.frames,
+            "janks": self.janks,
+            "max_interval": self.max_interval,
+            "timestamps": list(self.timestamps),
+            "paint_histogram": dict(
+                ("<={}".format(upper), n)
+                for upper, n in zip(PAINT_HISTOGRAM_BINS, self.paint_histogram)
+            ),
+        }
+
+
+class FrameProfiler(QtCore.QObject):
+    """
+    An opt-in profiler for the animated widgets in this package. When enabled, it
+    records frame timestamps, paint durations and the number of janks, i.e., frame
+    intervals longer than ``jank_factor`` times the expected interval, per animation.
+
+    Statistics can be exported as JSON with :meth:`toJson`. Every time an animation
+    finishes, :attr:`sig_report` is emitted with its key and statistics.
+
+    Animations are identified by the animated object and an optional animation name,
+    see :func:`profileKey`. Only the most recently active ``max_animations`` are kept.
+
+    Use :meth:`instance` to get the process-wide profiler. It is disabled by default and
+    costs a single attribute check per frame in that case.
+    """
+
+    sig_report = QtCore.pyqtSignal(str, object)
+
+    _instance = None
+
+    def __init__(self, max_frames=1000, max_animations=256, jank_factor=1.5):
+        QtCore.QObject.__init__(self, QtCore.QCoreApplication.instance())
+
+        self.enabled = False
+        self.max_frames = max_frames
+        self.max_animations = max_animations
+        self.jank_factor = jank_factor
+
+        self._stats = collections.OrderedDict()
+        self._clock = QtCore.QElapsedTimer()
+        self._clock.start()
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+
+    def isEnabled(self):
+        return self.enabled
+
+    def now(self):
+        """Returns a monotonic timestamp in ms."""
+        return self._clock.nsecsElapsed() / 1e6
+
+    def startAnimation(self, obj, animation=None, interval=1000.0/60):
+        """
+        Starts a new run of an animation, replacing its previous statistics.
+
+        :param obj: Animated object.
+        :param str animation: Optional name of the animation.
+        :param float interval: Expected frame interval in ms.
+        """
+        if self.enabled:
+            key = profileKey(obj, animation)
+            self._stats.pop(key, None)
+            self._add(key, interval)
+
+    def recordFrame(self, obj, animation=None):
+        """Records that a new animation frame was produced."""
+        if self.enabled:
+            self._get(profileKey(obj, animation)).frame(self.now(), self.jank_factor)
+
+    def recordPaint(self, obj, start, animation=None):
+        """
+        Records a paint duration.
+
+        :param obj: Animated object.
+        :param float start: Timestamp from :meth:`now` at the start of painting.
+        :param str animation: Optional name of the animation.
+        """
+        if self.enabled:
+            self._get(profileKey(obj, animation)).paint(self.now() - start)
+
+    def finishAnimation(self, obj, animation=None):
+        """Marks the end of an animation run and emits :attr:`sig_report`."""
+        if self.enabled:
+            key = profileKey(obj, animation)
+            if key in self._stats:
+                self.sig_report.emit(key, self._stats[key].to_dict())
+
+    def frameIntervals(self, obj, animation=None):
+        """Returns the intervals in ms between the recorded frames of an animation."""
+        stats = self._stats.get(profileKey(obj, animation))
+        if stats is None:
+            return []
+        timestamps = list(stats.timestamps)
+        return [b - a for a, b in zip(timestamps, timestamps[1:])]
+
+    def stats(self):
+        """Returns a dictionary with the statistics of all profiled animations."""
+        return dict((key, s.to_dict()) for key, s in self._stats.items())
+
+    def toJson(self, **kwargs):
+        """Returns all statistics as a JSON string. Kwargs are passed to json.dumps."""
+        return json.dumps(self.stats(), **kwargs)
+
+    def reset(self):
+        self._stats.clear()
+
+    def _get(self, key):
+        try:
+            return self._stats[key]
+        except KeyError:
+            return self._add(key, 1000.0/60)
+
+    def _add(self, key, interval):
+        stats = _AnimationStats(interval, self.max_frames)
+        self._stats[key] = stats
+        while len(self._stats) > self.max_animations:
+            self._stats.popitem(last=False)
+        return stats
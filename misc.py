@@ -6,17 +6,29 @@ Created on Wed Oct 31 16:23:13 2018
 @author: samschott
 """
 
-from PyQt5 import QtCore, QtGui, QtWidgets
+import functools
+import hashlib
+import os
+import logging
+import threading
+
+from PyQt5 import QtCore, QtGui, QtWidgets, sip
 from PyQt5.QtCore import Qt, QRect
-from PyQt5.QtGui import QBrush, QImage, QPainter, QPixmap, QWindow
+from PyQt5.QtGui import QBrush, QImage, QPainter, QPixmap
+
+from .dark_mode_support import appearance_probe
+
+
+logger = logging.getLogger(__name__)
 
 
 _USER_DIALOG_ICON_SIZE = 70
+_DETAILS_CHUNK_SIZE = 64 * 1024
 
 
 def elide_string(string, font=None, pixels=200, side="right"):
     """
-    Elides a string to fit into the given width.
+    Elides a string to fit into the given width. Font metrics and results are cached.
 
     :param str string: String to elide.
     :param font: Font to calculate size. If not given, the current style's default font
@@ -26,38 +38,155 @@ def elide_string(string, font=None, pixels=200, side="right"):
     :return: Truncated string.
     :rtype: str
     """
+    font_key = _cache_font_metrics(font)
+    return _elide_cached(string, font_key, pixels, side)
+
+
+def elide_strings(strings, font=None, pixels=200, side="right"):
+    """
+    Elides a list of strings to fit into the given width. This is faster than calling
+    :func:`elide_string` for each string.
+
+    :param strings: Iterable of strings to elide.
+    :param font: Font to calculate size. If not given, the current style's default font
+        for a QLabel is used.
+    :param int pixels: Maximum width in pixels.
+    :param str side: Side to truncate. Can be "right" or "left", defaults to "right".
+    :return: List of truncated strings.
+    :rtype: list
+    """
+    font_key = _cache_font_metrics(font)
+    return [_elide_cached(string, font_key, pixels, side) for string in strings]
 
+
+_font_metrics = {}
+
+
+def _cache_font_metrics(font):
+    # returns a hashable key for the font and caches its metrics
     if not font:
-        font = QtWidgets.QLabel().font()
+        font = QtWidgets.QApplication.font("QLabel")
+
+    key = font.key()
+
+    if key not in _font_metrics:
+        _watch_font_changes()
+        _font_metrics[key] = QtGui.QFontMetrics(font)
+
+    return key
+
+
+@functools.lru_cache(maxsize=4096)
+def _elide_cached(string, font_key, pixels, side):
+    mode = Qt.ElideRight if side == "right" else Qt.ElideLeft
+    return _font_metrics[font_key].elidedText(string, mode, pixels)
+
+
+_font_cache = {}
+_font_cache_connected = False
+
+
+def _clear_font_caches():
+    _font_cache.clear()
+    _font_metrics.clear()
+    _elide_cached.cache_clear()
+
 
-    metrics = QtGui.QFontMetrics(font)
-    mode = Qt.ElideRight if side is "right" else Qt.ElideLeft
+def _watch_font_changes():
+    global _font_cache_connected
 
-    return metrics.elidedText(string, mode, pixels)
+    if not _font_cache_connected:
+        probe = appearance_probe()
+        probe.sig_font_changed.connect(_clear_font_caches)
+        probe.sig_style_changed.connect(_clear_font_caches)
+        _font_cache_connected = True
 
 
 def get_scaled_font(scaling=1.0, bold=False, italic=False):
     """
     Returns the current style's default font for a QLabel but scaled by the given factor.
+    Fonts are cached until the application's font or style changes.
 
     :param float scaling: Scaling factor.
     :param bool bold: Sets the returned font to bold (defaults to ``False``)
     :param bool italic: Sets the returned font to italic (defaults to ``False``)
     :return: `QFont`` instance.
     """
-    label = QtWidgets.QLabel()
-    font = label.font()
+    key = (scaling, bold, italic)
+
+    try:
+        return QtGui.QFont(_font_cache[key])
+    except KeyError:
+        pass
+
+    _watch_font_changes()
+
+    font = QtWidgets.QApplication.font("QLabel")
     font.setBold(bold)
     font.setItalic(italic)
     font_size = round(font.pointSize()*scaling)
     # noinspection PyTypeChecker
     font.setPointSize(font_size)
 
+    _font_cache[key] = QtGui.QFont(font)
+
     return font
 
 
+_device_pixel_ratio = None
+_screens_connected = False
+
+
+def _clear_device_pixel_ratio():
+    global _device_pixel_ratio
+    _device_pixel_ratio = None
+
+
+def _watch_screen(screen):
+    screen.geometryChanged.connect(_clear_device_pixel_ratio)
+    screen.logicalDotsPerInchChanged.connect(_clear_device_pixel_ratio)
+    screen.physicalDotsPerInchChanged.connect(_clear_device_pixel_ratio)
+
+
+def _on_screen_added(screen):
+    _watch_screen(screen)
+    _clear_device_pixel_ratio()
+
+
+def _watch_screen_changes():
+    global _screens_connected
+
+    if not _screens_connected:
+        app = QtGui.QGuiApplication.instance()
+        app.primaryScreenChanged.connect(_clear_device_pixel_ratio)
+        app.screenAdded.connect(_on_screen_added)
+        app.screenRemoved.connect(_clear_device_pixel_ratio)
+        for screen in app.screens():
+            _watch_screen(screen)
+        _screens_connected = True
+
+
+def get_device_pixel_ratio():
+    """
+    Returns the device pixel ratio of the primary screen. The value is cached and
+    updated when screens are added, removed or change their resolution.
+
+    :return: Device pixel ratio.
+    :rtype: float
+    """
+    global _device_pixel_ratio
+
+    if _device_pixel_ratio is None:
+        _watch_screen_changes()
+        screen = QtGui.QGuiApplication.primaryScreen()
+        _device_pixel_ratio = screen.devicePixelRatio() if screen else 1.0
+
+    return _device_pixel_ratio
+
+
 def icon_to_pixmap(icon, width, height=None):
     """Converts a given icon to a pixmap. Automatically adjusts to high-DPI scaling.
+    Pixmaps are cached per icon, size and device pixel ratio.
 
     :param icon: Icon to convert.
     :param int width: Target point height.
@@ -68,77 +197,560 @@ def icon_to_pixmap(icon, width, height=None):
         height = width
 
     is_hidpi = QtCore.QCoreApplication.testAttribute(Qt.AA_UseHighDpiPixmaps)
-    pr = QWindow().devicePixelRatio()
+    pr = get_device_pixel_ratio()
+
+    key = "icon-{}-{}x{}-{}-{}".format(icon.cacheKey(), width, height, pr, is_hidpi)
+    px = QtGui.QPixmapCache.find(key)
 
-    if not is_hidpi:
-        width = width*pr
-        height = height*pr
-    px = icon.pixmap(width, height)
-    if not is_hidpi:
+    if px is not None and not px.isNull():
+        return px
+
+    if is_hidpi:
+        px = icon.pixmap(width, height)
+    else:
+        px = icon.pixmap(int(round(width*pr)), int(round(height*pr)))
         px.setDevicePixelRatio(pr)
 
+    QtGui.QPixmapCache.insert(key, px)
+
     return px
 
 
+class CancellationToken(object):
+    """
+    A token which is passed to the target of a :class:`BackgroundTask` to support
+    cooperative cancellation and progress reporting. Long-running targets should
+    periodically check :meth:`is_cancelled` and return early if it is ``True``.
+    """
+
+    def __init__(self, progress_callback=None):
+        self._cancelled = threading.Event()
+        self._progress_callback = progress_callback
+
+    def cancel(self):
+        """Requests cancellation of the task."""
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        """Returns ``True`` if cancellation has been requested."""
+        return self._cancelled.is_set()
+
+    def set_progress(self, fraction):
+        """
+        Reports the task's progress, emitted as :attr:`BackgroundTask.sig_progress`.
+
+        :param float fraction: Progress between 0.0 and 1.0.
+        """
+        if self._progress_callback:
+            self._progress_callback(float(fraction))
+
+
+# finished futures whose done callbacks have not run yet, kept alive until they have
+_pending_futures = set()
+
+
+class TaskFuture(QtCore.QObject):
+    """
+    The eventual result of a :class:`BackgroundTask`, modelled after
+    :class:`concurrent.futures.Future`.
+
+    :meth:`result` and :meth:`exception` block until the task is done. Callbacks
+    registered with :meth:`add_done_callback` are called with the future as argument in
+    the thread which the future belongs to, typically the GUI thread, so they may
+    safely update widgets or start follow-up tasks. A future can also be awaited from
+    coroutines running on an asyncio event loop.
+    """
+
+    _sig_finished = QtCore.pyqtSignal()
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._threadsafe_callbacks = []
+        self._sig_finished.connect(self._run_callbacks)
+
+    def done(self):
+        """Returns ``True`` if the task has finished or raised an exception."""
+        return self._done
+
+    def result(self, timeout=None):
+        """
+        Returns the task's return value, waiting for at most *timeout* seconds. Raises
+        the task's exception if it raised one.
+
+        :raises: TimeoutError if the task is not done in time.
+        """
+        self._wait_or_raise(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Returns the exception raised by the task or ``None``, waiting for at most
+        *timeout* seconds.
+
+        :raises: TimeoutError if the task is not done in time.
+        """
+        self._wait_or_raise(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Adds a callable which is called with the future once it is done. If the future
+        is already done, *fn* is called immediately.
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+    def wait(self, timeout=None):
+        """
+        Waits for at most *timeout* seconds for the task to finish.
+
+        :return: ``True`` if the task is done, ``False`` otherwise.
+        """
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            return self._done
+
+    def __await__(self):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        aio_future = loop.create_future()
+
+        def transfer():
+            if aio_future.cancelled():
+                return
+            if self._exception is not None:
+                aio_future.set_exception(self._exception)
+            else:
+                aio_future.set_result(self._result)
+
+        self._add_threadsafe_callback(lambda: loop.call_soon_threadsafe(transfer))
+
+        return aio_future.__await__()
+
+    def _add_threadsafe_callback(self, fn):
+        # called without arguments in the thread which finishes the task
+        with self._condition:
+            if not self._done:
+                self._threadsafe_callbacks.append(fn)
+                return
+        fn()
+
+    def _set(self, result, exception):
+        with self._condition:
+            self._result = result
+            self._exception = exception
+            self._done = True
+            self._condition.notify_all()
+
+        for fn in self._threadsafe_callbacks:
+            fn()
+
+        _pending_futures.add(self)
+
+        try:
+            self._sig_finished.emit()
+        except RuntimeError:
+            # the future has been deleted by its parent, nobody is waiting for callbacks
+            _pending_futures.discard(self)
+
+    def _wait_or_raise(self, timeout):
+        if not self.wait(timeout):
+            raise TimeoutError("Task did not finish within {} sec".format(timeout))
+
+    @QtCore.pyqtSlot()
+    def _run_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        try:
+            for fn in callbacks:
+                fn(self)
+        finally:
+            _pending_futures.discard(self)
+
+
 class Worker(QtCore.QObject):
-    """A worker object. To be used in QThreads."""
+    """
+    A worker object. To be used in QThreads. Exactly one of :attr:`sig_done` and
+    :attr:`sig_error` is emitted when the target returns or raises, followed by
+    :attr:`sig_finished`.
+    """
 
     sig_done = QtCore.pyqtSignal(object)
+    sig_error = QtCore.pyqtSignal(object)
+    sig_finished = QtCore.pyqtSignal()
+    sig_progress = QtCore.pyqtSignal(float)
 
-    def __init__(self, target=None, args=None, kwargs=None):
+    def __init__(self, target=None, args=None, kwargs=None, future=None):
         QtCore.QObject.__init__(self)
         self._target = target
         self._args = args or ()
         self._kwargs = kwargs or {}
+        self._future = future
 
     def start(self):
-        res = self._target(*self._args, **self._kwargs)
-        self.sig_done.emit(res)
+        try:
+            res = self._target(*self._args, **self._kwargs)
+        except Exception as exc:
+            if self._future:
+                self._future.set_exception(exc)
+            self.sig_error.emit(exc)
+        else:
+            if self._future:
+                self._future.set_result(res)
+            self.sig_done.emit(res)
+        finally:
+            self.sig_finished.emit()
+
+
+class _WorkerRunnable(QtCore.QRunnable):
+    """Runs a worker in a thread from a ``QThreadPool``."""
+
+    def __init__(self, worker):
+        QtCore.QRunnable.__init__(self)
+        self.worker = worker
+
+    def run(self):
+        # an exception escaping from QRunnable.run aborts the process
+        try:
+            self.worker.start()
+        except Exception:
+            logger.exception("Error in background task")
+
+
+_thread_pool = None
+
+
+def get_thread_pool(max_threads=None):
+    """
+    Returns a thread pool which is shared by all pooled :class:`BackgroundTask`s.
+
+    :param int max_threads: If given, sets the maximum number of worker threads.
+        Defaults to the number of CPU cores.
+    :return: ``QThreadPool`` instance.
+    """
+    global _thread_pool
+
+    if _thread_pool is None:
+        _thread_pool = QtCore.QThreadPool(QtCore.QCoreApplication.instance())
+
+    if max_threads is not None:
+        _thread_pool.setMaxThreadCount(max_threads)
+
+    return _thread_pool
 
 
 class BackgroundTask(QtCore.QObject):
-    """A utility class to manage a worker thread."""
+    """
+    A utility class to manage a worker thread.
+
+    By default, every task runs in its own ``QThread``. If a ``QThreadPool`` is given
+    as *pool*, for instance the shared pool from :func:`get_thread_pool`, the task is
+    instead run in one of the pool's threads. This is much cheaper when running many
+    short tasks.
+
+    If *with_token* is ``True``, a :class:`CancellationToken` is passed to the target as
+    keyword argument ``token``. The target can use it to check for cancellation
+    requested by :meth:`cancel` and to report progress through :attr:`sig_progress`.
+    If a *timeout* in ms is given, the task is cancelled when it has not finished in
+    time and :meth:`wait` will not block for longer than the timeout.
+
+    If the target raises an exception, it is emitted with :attr:`sig_error` instead of
+    :attr:`sig_done`. Both the result and exception are also available from
+    :attr:`future`, a :class:`TaskFuture` which is created when the task is started.
+    """
 
     sig_done = QtCore.pyqtSignal(object)
+    sig_error = QtCore.pyqtSignal(object)
+    sig_progress = QtCore.pyqtSignal(float)
 
-    def __init__(self, parent=None, target=None, args=None, kwargs=None, autostart=True):
+    def __init__(self, parent=None, target=None, args=None, kwargs=None, autostart=True,
+                 pool=None, with_token=False, timeout=None):
         QtCore.QObject.__init__(self, parent)
         self._target = target
         self._args = args or ()
         self._kwargs = kwargs or {}
+        self._pool = pool
+        self._with_token = with_token
+        self._timeout = timeout
+        self.token = None
+        self.future = None
 
         if autostart:
             self.start()
 
     def start(self):
 
+        kwargs = dict(self._kwargs)
+
+        # the future is not owned by the task so that it outlives the task if the
+        # task is deleted before the target returns
+        self.future = TaskFuture()
+        self.worker = Worker(target=self._target, args=self._args, kwargs=kwargs,
+                             future=self.future)
+        self.worker.sig_done.connect(self.sig_done)
+        self.worker.sig_error.connect(self.sig_error)
+        self.worker.sig_progress.connect(self.sig_progress)
+
+        self.token = CancellationToken(progress_callback=self.worker.sig_progress.emit)
+
+        if self._with_token:
+            self.worker._kwargs["token"] = self.token
+
+        self._elapsed = QtCore.QElapsedTimer()
+        self._elapsed.start()
+
+        if self._timeout is not None:
+            QtCore.QTimer.singleShot(self._timeout, self._on_timeout)
+
+        if self._pool is not None:
+            self.thread = None
+            self._pool.start(_WorkerRunnable(self.worker))
+            return
+
         self.thread = QtCore.QThread(self)
-        self.worker = Worker(target=self._target, args=self._args, kwargs=self._kwargs)
-        self.worker.sig_done.connect(self.sig_done.emit)
-        self.worker.sig_done.connect(self.thread.quit)
+        # quit directly from the worker thread: a queued call would never be
+        # delivered while the GUI thread blocks in wait()
+        self.worker.sig_finished.connect(self.thread.quit, Qt.DirectConnection)
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.start)
         self.thread.start()
 
     def wait(self, timeout=None):
-        if timeout:
-            self.thread.wait(msecs=timeout)
+        """
+        Blocks until the task is done, the given timeout in ms has passed or the task's
+        own timeout has expired. In the latter case, the task is cancelled.
+
+        :return: ``True`` if the task is done, ``False`` otherwise.
+        """
+        task_timeout = None
+
+        if self._timeout is not None:
+            task_timeout = max(0, self._timeout - self._elapsed.elapsed())
+
+        if task_timeout is not None and (timeout is None or task_timeout < timeout):
+            timeout = task_timeout
+        else:
+            task_timeout = None
+
+        waited = QtCore.QElapsedTimer()
+        waited.start()
+
+        done = self.future.wait(timeout / 1000.0 if timeout is not None else None)
+
+        if done and self.thread is not None:
+            # the future is set before the thread's event loop quits, wait until the
+            # thread has exited so that the task can be safely deleted
+            if timeout is None:
+                done = self.thread.wait()
+            else:
+                done = self.thread.wait(max(0, int(timeout - waited.elapsed())))
+
+        if not done and task_timeout is not None:
+            self.cancel()
+
+        return done
+
+    @QtCore.pyqtSlot()
+    def cancel(self):
+        """Requests cooperative cancellation of the task."""
+        if self.token:
+            self.token.cancel()
+
+    def is_cancelled(self):
+        return self.token is not None and self.token.is_cancelled()
+
+    @QtCore.pyqtSlot()
+    def _on_timeout(self):
+        self.cancel()
+
+
+def _run_batch(batch):
+    # runs a list of calls in the current thread and fans out results to their futures
+    for target, args, kwargs, future in batch:
+        try:
+            res = target(*args, **kwargs)
+        except Exception as exc:
+            future.set_exception(exc)
         else:
-            self.thread.wait()
+            future.set_result(res)
+
+
+class TaskDispatcher(QtCore.QObject):
+    """
+    Submits :class:`BackgroundTask`s, coalescing identical requests and optionally
+    batching many small calls into one worker invocation.
+
+    Requests with the same key which are submitted while a previous one is still in
+    flight are not run again but share the :class:`TaskFuture` of the first request.
+    By default, the key is derived from the target and its arguments, which must then
+    be hashable.
+
+    Calls submitted with :meth:`submit_batched` are collected for *batch_interval* ms,
+    or until *max_batch_size* calls are pending, and then run one after another by a
+    single worker.
+
+    :param parent: Parent object.
+    :param pool: ``QThreadPool`` to run in. Defaults to the shared pool from
+        :func:`get_thread_pool`.
+    :param int batch_interval: Time in ms to collect batched calls.
+    :param int max_batch_size: Maximum number of calls per batch.
+    """
+
+    def __init__(self, parent=None, pool=None, batch_interval=10, max_batch_size=50):
+        QtCore.QObject.__init__(self, parent)
+        self._pool = pool or get_thread_pool()
+        self._in_flight = {}
+        self._batch = []
+        self.max_batch_size = max_batch_size
+
+        self._batch_timer = QtCore.QTimer(self)
+        self._batch_timer.setSingleShot(True)
+        self._batch_timer.setInterval(batch_interval)
+        self._batch_timer.timeout.connect(self.flush)
+
+    def submit(self, target, args=None, kwargs=None, key=None):
+        """
+        Runs *target* in a background thread unless an identical request is in flight.
+
+        :param target: Callable to run.
+        :param tuple args: Positional arguments for *target*.
+        :param dict kwargs: Keyword arguments for *target*.
+        :param key: Hashable key which identifies identical requests.
+        :return: :class:`TaskFuture` of the request.
+        """
+        args, kwargs, key = self._normalize(target, args, kwargs, key)
+
+        try:
+            return self._in_flight[key]
+        except KeyError:
+            pass
+
+        task = BackgroundTask(self, target=target, args=args, kwargs=kwargs,
+                              pool=self._pool)
+        self._track(key, task.future, task)
+
+        return task.future
+
+    def submit_batched(self, target, args=None, kwargs=None, key=None):
+        """
+        Like :meth:`submit` but runs the call together with other batched calls in a
+        single worker invocation.
+
+        :return: :class:`TaskFuture` of the request.
+        """
+        args, kwargs, key = self._normalize(target, args, kwargs, key)
+
+        try:
+            return self._in_flight[key]
+        except KeyError:
+            pass
+
+        future = TaskFuture()
+        self._track(key, future)
+        self._batch.append((target, args, kwargs, future))
+
+        if len(self._batch) >= self.max_batch_size:
+            self.flush()
+        elif not self._batch_timer.isActive():
+            self._batch_timer.start()
+
+        return future
+
+    @QtCore.pyqtSlot()
+    def flush(self):
+        """Starts all pending batched calls immediately."""
+        self._batch_timer.stop()
+
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        task = BackgroundTask(self, target=_run_batch, args=(batch,), pool=self._pool)
+        task.future.add_done_callback(lambda f: task.deleteLater())
+
+    def in_flight(self):
+        """Returns the number of distinct requests which have not finished yet."""
+        return len(self._in_flight)
+
+    @staticmethod
+    def _normalize(target, args, kwargs, key):
+        args = tuple(args or ())
+        kwargs = kwargs or {}
+        if key is None:
+            key = (target, args, tuple(sorted(kwargs.items())))
+        return args, kwargs, key
+
+    def _track(self, key, future, task=None):
+        self._in_flight[key] = future
+
+        def on_done(f):
+            if self._in_flight.get(key) is f:
+                del self._in_flight[key]
+            if task:
+                task.deleteLater()
+
+        future.add_done_callback(on_done)
+
+
+# maximum number of recycled instances per dialog class
+_MAX_POOLED_DIALOGS = 8
+
+
+def _acquire_pooled_dialog(pool, parent):
+    # returns a hidden dialog with the given parent from the pool or None
+    pool[:] = [d for d in pool if not sip.isdeleted(d)]
+    for dialog in pool:
+        if dialog.parentWidget() is parent and not dialog.isVisible():
+            # handlers connected by previous users must not fire for the new content
+            for signal in (dialog.accepted, dialog.rejected, dialog.finished):
+                try:
+                    signal.disconnect()
+                except TypeError:
+                    pass
+            return dialog
+    return None
 
 
 class BackgroundTaskProgressDialog(QtWidgets.QDialog):
-    """A progress dialog to show during long-running background tasks."""
+    """
+    A progress dialog to show during long-running background tasks. Dialogs created
+    with ``reusable=True`` are not deleted when closed and can be shown again with new
+    content, see :meth:`setContent` and :meth:`pooled`.
+    """
+
+    _pool = []
 
-    def __init__(self, icon, title, message="", cancel=True, parent=None, width=450, icon_size=_USER_DIALOG_ICON_SIZE):
+    def __init__(self, icon, title, message="", cancel=True, parent=None, width=450, icon_size=_USER_DIALOG_ICON_SIZE,
+                 task=None, reusable=False):
         super(self.__class__, self).__init__(parent=parent)
         self.setModal(True)
         self.setWindowModality(Qt.WindowModal)
         self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.Sheet | Qt.WindowTitleHint | Qt.CustomizeWindowHint)
-        self.setAttribute(Qt.WA_DeleteOnClose)
+        if not reusable:
+            self.setAttribute(Qt.WA_DeleteOnClose)
         self.setWindowTitle("")
         self.setFixedWidth(width)
 
+        self.icon_size = icon_size
+        self._task = None
+
         self.gridLayout = QtWidgets.QGridLayout()
         self.setLayout(self.gridLayout)
 
@@ -158,44 +770,110 @@ class BackgroundTaskProgressDialog(QtWidgets.QDialog):
         self.infoLabel.setWordWrap(True)
         self.infoLabel.setOpenExternalLinks(True)
 
-        self.iconLabel.setPixmap(icon_to_pixmap(icon, icon_size))
-        self.titleLabel.setText(title)
-        self.infoLabel.setText(message)
-
         self.buttonBox.rejected.connect(self.reject)
-        self.progressBar.setMinimum(0)
-        self.progressBar.setMaximum(0)
 
+        # hidden rows take up no space
         self.gridLayout.addWidget(self.iconLabel, 0, 0, 3, 1)
         self.gridLayout.addWidget(self.titleLabel, 0, 1, 1, 1)
+        self.gridLayout.addWidget(self.infoLabel, 1, 1, 1, 1)
+        self.gridLayout.addWidget(self.progressBar, 2, 1, 1, 1)
+        self.gridLayout.addWidget(self.buttonBox, 3, 1, -1, -1)
 
-        if message:
-            self.gridLayout.addWidget(self.infoLabel, 1, 1, 1, 1)
-            self.gridLayout.addWidget(self.progressBar, 2, 1, 1, 1)
+        self.setContent(icon, title, message, cancel, task)
+
+    @classmethod
+    def pooled(cls, icon, title, message="", cancel=True, parent=None, task=None):
+        """
+        Returns a recycled dialog with the given content. If a hidden dialog with the
+        same parent has been created by this method before, only its content is
+        replaced and all handlers connected to its ``accepted``, ``rejected`` and
+        ``finished`` signals by previous users are disconnected. Otherwise, a new
+        reusable dialog is created. The dialog should be shown right away.
+        """
+        dialog = _acquire_pooled_dialog(cls._pool, parent)
+
+        if dialog is None:
+            reusable = len(cls._pool) < _MAX_POOLED_DIALOGS
+            dialog = cls(icon, title, message, cancel, parent, task=task, reusable=reusable)
+            if reusable:
+                cls._pool.append(dialog)
         else:
-            self.gridLayout.addWidget(self.progressBar, 1, 1, 1, 1)
+            dialog.setContent(icon, title, message, cancel, task)
+            dialog.setResult(0)
+
+        return dialog
+
+    def setContent(self, icon, title, message="", cancel=True, task=None):
+        """
+        Replaces the icon, title and message, resets the progress bar and disconnects
+        any previous task.
+        """
+        self._disconnectTask()
+
+        self.iconLabel.setPixmap(icon_to_pixmap(icon, self.icon_size))
+        self.titleLabel.setText(title)
+        self.infoLabel.setText(message)
+        self.infoLabel.setVisible(bool(message))
+        self.buttonBox.setVisible(cancel)
+        self.progressBar.setRange(0, 0)
 
-        if message and cancel:
-            self.gridLayout.addWidget(self.buttonBox, 3, 1, -1, -1)
-        elif cancel:
-            self.gridLayout.addWidget(self.buttonBox, 2, 1, -1, -1)
+        if task:
+            self.connectTask(task)
 
         self.adjustSize()
 
+    def connectTask(self, task):
+        """
+        Shows the progress of a :class:`BackgroundTask` and cancels it when the dialog
+        is cancelled. The task should be created with ``with_token=True`` so that it
+        can react to cancellation.
+        """
+        self._disconnectTask()
+        task.sig_progress.connect(self.setProgress)
+        self.rejected.connect(task.cancel)
+        self._task = task
+
+    def _disconnectTask(self):
+        task, self._task = self._task, None
+        if task is not None and not sip.isdeleted(task):
+            try:
+                task.sig_progress.disconnect(self.setProgress)
+                self.rejected.disconnect(task.cancel)
+            except TypeError:
+                pass
+
+    @QtCore.pyqtSlot(float)
+    def setProgress(self, fraction):
+        """
+        Switches the progress bar from indeterminate to determinate and sets its value.
+
+        :param float fraction: Progress between 0.0 and 1.0.
+        """
+        self.progressBar.setMaximum(100)
+        self.progressBar.setValue(round(fraction*100))
+
 
 class UserDialog(QtWidgets.QDialog):
-    """A template user dialog. Shows a traceback if given in constructor."""
+    """
+    A template user dialog. Shows a traceback if given in constructor. Dialogs created
+    with ``reusable=True`` are not deleted when closed and can be shown again with new
+    content, see :meth:`setContent` and :meth:`pooled`.
+    """
+
+    _pool = []
 
-    def __init__(self, icon, title, message, details=None, parent=None, icon_size=_USER_DIALOG_ICON_SIZE):
+    def __init__(self, icon, title, message, details=None, parent=None, icon_size=_USER_DIALOG_ICON_SIZE,
+                 reusable=False):
         super(self.__class__, self).__init__(parent=parent)
         self.setModal(True)
         self.setWindowModality(Qt.WindowModal)
         self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.Sheet | Qt.WindowTitleHint |
                             Qt.CustomizeWindowHint)
-        self.setAttribute(Qt.WA_DeleteOnClose)
+        if not reusable:
+            self.setAttribute(Qt.WA_DeleteOnClose)
         self.setWindowTitle("")
-        width = 550 if details else 450
-        self.setFixedWidth(width)
+
+        self.icon_size = icon_size
 
         self.gridLayout = QtWidgets.QGridLayout()
         self.setLayout(self.gridLayout)
@@ -208,33 +886,102 @@ class UserDialog(QtWidgets.QDialog):
         self.iconLabel.setMaximumSize(icon_size, icon_size)
         self.titleLabel.setFont(get_scaled_font(bold=True))
         self.infoLabel.setFont(get_scaled_font(scaling=0.9))
-        self.infoLabel.setFixedWidth(width-150)
         self.infoLabel.setSizePolicy(QtWidgets.QSizePolicy.MinimumExpanding,
                                      QtWidgets.QSizePolicy.MinimumExpanding)
         self.infoLabel.setWordWrap(True)
         self.infoLabel.setOpenExternalLinks(True)
 
-        self.iconLabel.setPixmap(icon_to_pixmap(icon, icon_size))
-        self.titleLabel.setText(title)
-        self.infoLabel.setText(message)
-
-        if details:
-            self.details = QtWidgets.QTextBrowser(self)
-            self.details.setText("".join(details))
-            self.details.setOpenExternalLinks(True)
+        # details are shown as plain text and appended in chunks from the event loop
+        # so that the dialog opens immediately even for very long tracebacks or logs
+        self.details = QtWidgets.QPlainTextEdit(self)
+        self.details.setReadOnly(True)
+        self._details = ""
+        self._detailsOffset = 0
+        self._detailsTimer = QtCore.QTimer(self)
+        self._detailsTimer.setInterval(0)
+        self._detailsTimer.timeout.connect(self._appendDetailsChunk)
 
         self.buttonBox = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok)
         self.buttonBox.accepted.connect(self.accept)
+        self._acceptButtonName = self.buttonBox.buttons()[0].text()
 
         self.gridLayout.addWidget(self.iconLabel, 0, 0, 2, 1)
         self.gridLayout.addWidget(self.titleLabel, 0, 1, 1, 1)
         self.gridLayout.addWidget(self.infoLabel, 1, 1, 1, 1)
-        if details:
-            self.gridLayout.addWidget(self.details, 2, 1, 1, 1)
+        self.gridLayout.addWidget(self.details, 2, 1, 1, 1)
         self.gridLayout.addWidget(self.buttonBox, 3, 1, -1, -1)
 
+        self.setContent(icon, title, message, details)
+
+    @classmethod
+    def pooled(cls, icon, title, message, details=None, parent=None):
+        """
+        Returns a recycled dialog with the given content. If a hidden dialog with the
+        same parent has been created by this method before, only its content is
+        replaced, any buttons added with :meth:`addCancelButton` or
+        :meth:`addSecondAcceptButton` are removed and all handlers connected to its
+        ``accepted``, ``rejected`` and ``finished`` signals by previous users are
+        disconnected. Otherwise, a new reusable dialog is created. The dialog should be
+        shown right away.
+        """
+        dialog = _acquire_pooled_dialog(cls._pool, parent)
+
+        if dialog is None:
+            reusable = len(cls._pool) < _MAX_POOLED_DIALOGS
+            dialog = cls(icon, title, message, details, parent, reusable=reusable)
+            if reusable:
+                cls._pool.append(dialog)
+        else:
+            dialog._resetButtons()
+            dialog.setContent(icon, title, message, details)
+            dialog.setResult(0)
+
+        return dialog
+
+    def setContent(self, icon, title, message, details=None):
+        """Replaces the icon, title, message and details."""
+        width = 550 if details else 450
+        self.setFixedWidth(width)
+        self.infoLabel.setFixedWidth(width-150)
+
+        self.iconLabel.setPixmap(icon_to_pixmap(icon, self.icon_size))
+        self.titleLabel.setText(title)
+        self.infoLabel.setText(message)
+
+        self._details = "".join(details) if details else ""
+        self._detailsOffset = _DETAILS_CHUNK_SIZE
+        self.details.setPlainText(self._details[:_DETAILS_CHUNK_SIZE])
+        self.details.setVisible(bool(details))
+
+        if len(self._details) > _DETAILS_CHUNK_SIZE:
+            self._detailsTimer.start()
+        else:
+            self._detailsTimer.stop()
+            self._details = ""
+
         self.adjustSize()
 
+    @QtCore.pyqtSlot()
+    def _appendDetailsChunk(self):
+        chunk = self._details[self._detailsOffset:self._detailsOffset + _DETAILS_CHUNK_SIZE]
+        self._detailsOffset += _DETAILS_CHUNK_SIZE
+
+        cursor = QtGui.QTextCursor(self.details.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.insertText(chunk)
+
+        if self._detailsOffset >= len(self._details):
+            self._detailsTimer.stop()
+            self._details = ""
+
+    def _resetButtons(self):
+        accept_button = self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok)
+        for button in self.buttonBox.buttons():
+            if button is not accept_button:
+                self.buttonBox.removeButton(button)
+                button.deleteLater()
+        accept_button.setText(self._acceptButtonName)
+
     def setAcceptButtonName(self, name):
         self.buttonBox.buttons()[0].setText(name)
 
@@ -260,36 +1007,199 @@ class UserDialog(QtWidgets.QDialog):
         self._acceptButton2.setText(name)
 
 
+_masked_image_cache_dir = None
+_masked_image_cache_max_files = 500
+
+
+def set_masked_image_cache_dir(path, max_files=500):
+    """
+    Enables caching of images rendered by :func:`get_masked_image` on disk. The disk
+    cache is disabled by default. When it holds more than *max_files* images, the least
+    recently written ones are deleted.
+
+    :param str path: Cache directory. ``None`` or an empty string disable the cache.
+    :param int max_files: Maximum number of cached images.
+    """
+    global _masked_image_cache_dir, _masked_image_cache_max_files
+    _masked_image_cache_dir = path or None
+    _masked_image_cache_max_files = max_files
+
+
+def _get_masked_image_cache_dir():
+    return _masked_image_cache_dir
+
+
+def _prune_masked_image_cache(cache_dir):
+    try:
+        entries = [e for e in os.scandir(cache_dir)
+                   if e.name.startswith("masked-") and e.name.endswith(".png")]
+        excess = len(entries) - _masked_image_cache_max_files
+        if excess > 0:
+            entries.sort(key=lambda e: e.stat().st_mtime)
+            for entry in entries[:excess]:
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+
 def get_masked_image(path, size=64, overlay_text=""):
     """
     Returns a ``QPixmap`` from an image file masked with a smooth circle.
     The returned pixmap will have a size of *size* × *size* pixels.
 
+    Results are cached in memory with ``QPixmapCache`` and, if enabled with
+    :func:`set_masked_image_cache_dir`, on disk as PNG files, keyed by the file's path
+    and modification time, the size, the overlay text and the device pixel ratio.
+
+    Images are decoded at the target size only if Qt's image plugin for the format
+    supports it, e.g., for JPEG. Other formats, including TIFF, PNG and BMP, are still
+    decoded at full resolution before being cropped and scaled.
+
     :param str path: Path to image file.
     :param int size: Target size. Will be the diameter of the masked image.
     :param overlay_text: Overlay text. This will be shown in white sans-serif on top of
         the image.
     :return: `QPixmap`` instance.
     """
+    pr = get_device_pixel_ratio()
+    key = _masked_image_key(path, size, overlay_text, pr)
 
-    with open(path, "rb") as f:
-        imgdata = f.read()
+    pm = QtGui.QPixmapCache.find(key)
 
-    imgtype = path.split(".")[-1]
+    if pm is not None and not pm.isNull():
+        return pm
 
-    # Load image and convert to 32-bit ARGB (adds an alpha channel):
-    image = QImage.fromData(imgdata, imgtype)
-    image.convertToFormat(QImage.Format_ARGB32)
+    image = _load_masked_image(path, size, overlay_text, pr, key)
 
-    # Crop image to a square:
-    imgsize = min(image.width(), image.height())
-    rect = QRect(
-        (image.width() - imgsize) / 2,
-        (image.height() - imgsize) / 2,
-        imgsize,
-        imgsize,
-    )
-    image = image.copy(rect)
+    return _cache_masked_pixmap(image, pr, key)
+
+
+def get_masked_image_async(path, size=64, overlay_text="", pool=None):
+    """
+    Like :func:`get_masked_image` but reads, decodes, masks and scales the image in a
+    background thread. Only the conversion of the final image to a ``QPixmap`` runs in
+    the GUI thread. Must be called from the GUI thread.
+
+    :param str path: Path to image file.
+    :param int size: Target size. Will be the diameter of the masked image.
+    :param overlay_text: Overlay text. This will be shown in white sans-serif on top of
+        the image.
+    :param pool: ``QThreadPool`` to run in. Defaults to the shared pool from
+        :func:`get_thread_pool`.
+    :return: :class:`TaskFuture` which resolves to a ``QPixmap``.
+    """
+    pr = get_device_pixel_ratio()
+    future = TaskFuture()
+
+    try:
+        key = _masked_image_key(path, size, overlay_text, pr)
+    except OSError as exc:
+        future.set_exception(exc)
+        return future
+
+    pm = QtGui.QPixmapCache.find(key)
+
+    if pm is not None and not pm.isNull():
+        future.set_result(pm)
+        return future
+
+    task = BackgroundTask(target=_load_masked_image, args=(path, size, overlay_text, pr, key),
+                          pool=pool or get_thread_pool())
+
+    def on_done(f):
+        task.deleteLater()
+        if f.exception() is not None:
+            future.set_exception(f.exception())
+        else:
+            future.set_result(_cache_masked_pixmap(f.result(), pr, key))
+
+    task.future.add_done_callback(on_done)
+
+    return future
+
+
+def _load_masked_image(path, size, overlay_text, pr, key):
+    # Returns the masked image as QImage from the disk cache or renders it. This is
+    # safe to call outside of the GUI thread.
+    cache_dir = _get_masked_image_cache_dir()
+    cache_file = os.path.join(cache_dir, key + ".png") if cache_dir else None
+
+    image = QImage()
+
+    if cache_file and os.path.isfile(cache_file):
+        image.load(cache_file, "PNG")
+
+    if image.isNull():
+        image = _render_masked_image(path, size, overlay_text, pr)
+
+        if cache_file:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                image.save(cache_file, "PNG")
+            except OSError:
+                pass
+            else:
+                _prune_masked_image_cache(cache_dir)
+
+    return image
+
+
+def _cache_masked_pixmap(image, pr, key):
+    pm = QPixmap.fromImage(image)
+    pm.setDevicePixelRatio(pr)
+
+    QtGui.QPixmapCache.insert(key, pm)
+
+    return pm
+
+
+def _masked_image_key(path, size, overlay_text, pr):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = repr((path, stat.st_mtime, stat.st_size, size, overlay_text, pr))
+    return "masked-" + hashlib.sha1(key.encode()).hexdigest()
+
+
+def _render_masked_image(path, size, overlay_text, pr):
+    # Renders the masked image at the given pixel ratio. Only uses QImage and QPainter
+    # on a QImage, which is safe outside of the GUI thread.
+
+    size = int(round(size * pr))
+
+    # Decode only the central square of the image, directly at the target size where
+    # the image format supports it. This avoids reading the entire file into memory
+    # and decoding huge images at full resolution just to create a thumbnail. Plugins
+    # without ScaledSize and ClipRect support, such as TIFF, PNG and BMP, decode the
+    # full image and QImageReader crops and scales it afterwards:
+    reader = QtGui.QImageReader(path)
+    full_size = reader.size()
+
+    if full_size.isValid():
+        imgsize = min(full_size.width(), full_size.height())
+        reader.setClipRect(QRect(
+            (full_size.width() - imgsize) // 2,
+            (full_size.height() - imgsize) // 2,
+            imgsize,
+            imgsize,
+        ))
+        if imgsize > size:
+            imgsize = size
+            reader.setScaledSize(QtCore.QSize(size, size))
+        image = reader.read()
+    else:
+        # size is unknown before decoding, crop after reading
+        image = reader.read()
+        imgsize = min(image.width(), image.height())
+        rect = QRect(
+            (image.width() - imgsize) // 2,
+            (image.height() - imgsize) // 2,
+            imgsize,
+            imgsize,
+        )
+        image = image.copy(rect)
+
+    # Convert to 32-bit ARGB (adds an alpha channel):
+    image = image.convertToFormat(QImage.Format_ARGB32)
 
     # Create the output image with the same dimensions and an alpha channel
     # and make it completely transparent:
@@ -308,19 +1218,16 @@ def get_masked_image(path, size=64, overlay_text=""):
     if overlay_text:
         # draw text
         font = QtGui.QFont("Arial Rounded MT Bold")
-        font.setPointSize(imgsize * 0.4)
+        font.setPointSize(int(imgsize * 0.4))
         painter.setFont(font)
         painter.setPen(Qt.white)
         painter.drawText(QRect(0, 0, imgsize, imgsize), Qt.AlignCenter, overlay_text)
 
     painter.end()                # We are done (segfault if you forget this)
 
-    # Convert the image to a pixmap and rescale it.  Take pixel ratio into
-    # account to get a sharp image on retina displays:
-    pr = QWindow().devicePixelRatio()
-    pm = QPixmap.fromImage(out_img)
-    pm.setDevicePixelRatio(pr)
-    size *= pr
-    pm = pm.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    if imgsize == size:
+        return out_img
 
-    return pm
+    # Rescale the image. Take pixel ratio into account to get a sharp image on
+    # retina displays:
+    return out_img.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
@@ -6,51 +6,406 @@
 Attribution-NonCommercial-NoDerivs 2.0 UK: England & Wales License.
 
 """
-import os
+import collections
+import functools
+import logging
+import shutil
+import subprocess
+import threading
+import time
 from enum import Enum
 
+try:
+    from PyQt5 import QtCore, QtDBus
+except ImportError:
+    QtDBus = None
+
+
+logger = logging.getLogger(__name__)
+
 
 class SupportedImplementation(Enum):
     notify_send = 'notify-send'
     osascript = 'osascript'
 
 
+class OverflowPolicy(Enum):
+    drop_newest = 'drop-newest'
+    drop_oldest = 'drop-oldest'
+    merge = 'merge'
+
+
+class _TitleRate(object):
+
+    def __init__(self):
+        self.times = collections.deque()
+        self.suppressed = 0
+        self.last_message = None
+        self.timer = None
+
+
+class NotificationBackend(object):
+    """Base class for notification backends. Subclasses must implement :meth:`send`
+    and may override :meth:`is_available` if they depend on the platform."""
+
+    implementation = None
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def send(self, message, title):
+        raise NotImplementedError()
+
+
+class _CommandBackend(NotificationBackend):
+
+    command = None
+
+    @classmethod
+    def is_available(cls):
+        return shutil.which(cls.command) is not None
+
+    def args(self, message, title):
+        raise NotImplementedError()
+
+    def send(self, message, title):
+        try:
+            subprocess.run(self.args(message, title), stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=self.timeout)
+        except (OSError, subprocess.SubprocessError):
+            pass
+
+
+class OsascriptBackend(_CommandBackend):
+    """Shows notifications with AppleScript on macOS."""
+
+    implementation = SupportedImplementation.osascript
+    command = 'osascript'
+
+    def args(self, message, title):
+        # pass message and title as arguments to avoid quoting issues
+        return [
+            'osascript',
+            '-e', 'on run argv',
+            '-e', 'display notification (item 1 of argv) with title (item 2 of argv)',
+            '-e', 'end run',
+            message, title
+        ]
+
+
+class NotifySendBackend(_CommandBackend):
+    """Shows notifications with notify-send on linux."""
+
+    implementation = SupportedImplementation.notify_send
+    command = 'notify-send'
+
+    def args(self, message, title):
+        return ['notify-send', '--', title, message]
+
+
+class DBusBackend(NotificationBackend):
+    """Shows notifications by calling the org.freedesktop.Notifications service on the
+    session bus directly, without starting a process. Requires QtDBus."""
+
+    service = 'org.freedesktop.Notifications'
+    path = '/org/freedesktop/Notifications'
+
+    def __init__(self, timeout=10, app_name='', expire_timeout=-1):
+        NotificationBackend.__init__(self, timeout)
+        self.app_name = app_name
+        self.expire_timeout = expire_timeout
+
+    @classmethod
+    def is_available(cls):
+        if QtDBus is None:
+            return False
+
+        bus = QtDBus.QDBusConnection.sessionBus()
+
+        if not bus.isConnected():
+            return False
+
+        reply = bus.interface().isServiceRegistered(cls.service)
+        if reply.isValid() and reply.value():
+            return True
+
+        reply = bus.interface().call('ListActivatableNames')
+        return (reply.type() == QtDBus.QDBusMessage.ReplyMessage and
+                cls.service in reply.arguments()[0])
+
+    def send(self, message, title):
+        msg = QtDBus.QDBusMessage.createMethodCall(self.service, self.path, self.service, 'Notify')
+        msg.setArguments([
+            self.app_name,
+            QtDBus.QDBusArgument(0, QtCore.QMetaType.UInt),  # replaces_id
+            '',  # app_icon
+            title,
+            message,
+            QtDBus.QDBusArgument([], QtCore.QMetaType.QStringList),  # actions
+            {},  # hints
+            self.expire_timeout
+        ])
+        QtDBus.QDBusConnection.sessionBus().call(msg, QtDBus.QDBus.Block, int(self.timeout*1000))
+
+
+class CallbackBackend(NotificationBackend):
+    """Passes notifications to *callback* as ``callback(message, title)``. Logs them
+    with the logging module by default, e.g., for headless runs."""
+
+    def __init__(self, timeout=10, callback=None):
+        NotificationBackend.__init__(self, timeout)
+        self.callback = callback or self._log
+
+    @staticmethod
+    def _log(message, title):
+        logger.info('%s: %s', title, message)
+
+    def send(self, message, title):
+        self.callback(message, title)
+
+
+class MockBackend(NotificationBackend):
+    """Records notifications as (title, message) tuples in :attr:`sent`, for tests."""
+
+    def __init__(self, timeout=10):
+        NotificationBackend.__init__(self, timeout)
+        self.sent = []
+
+    def send(self, message, title):
+        self.sent.append((title, message))
+
+
+class StdoutBackend(NotificationBackend):
+    """Prints notifications to stdout."""
+
+    def send(self, message, title):
+        print('{}: {}'.format(title, message))
+
+
+# registered backends in order of preference for automatic discovery
+_backends = collections.OrderedDict()
+
+
+def register_backend(name, backend, discoverable=True):
+    """
+    Registers a notification backend so that it can be selected by name in
+    :class:`Notipy`.
+
+    :param str name: Name of the backend.
+    :param backend: :class:`NotificationBackend` subclass.
+    :param bool discoverable: Whether the backend may be chosen automatically if
+        available. Backends registered later have a lower priority.
+    """
+    _backends[name] = (backend, discoverable)
+    get_default_backend.cache_clear()
+
+
+def get_backend(name):
+    """Returns the backend class registered under *name*."""
+    try:
+        return _backends[name][0]
+    except KeyError:
+        raise ValueError('Unknown notification backend "{}"'.format(name))
+
+
+@functools.lru_cache(maxsize=None)
+def get_default_backend():
+    """Returns the first available discoverable backend class. The result is cached
+    until another backend is registered."""
+    for backend, discoverable in _backends.values():
+        if discoverable and backend.is_available():
+            return backend
+    return StdoutBackend
+
+
+register_backend('dbus', DBusBackend)
+register_backend('osascript', OsascriptBackend)
+register_backend('notify-send', NotifySendBackend)
+register_backend('callback', CallbackBackend, discoverable=False)
+register_backend('mock', MockBackend, discoverable=False)
+register_backend('stdout', StdoutBackend)
+
+
 class Notipy(object):
     """Send native OS notifications to user.
 
-    Relies on AppleScript on macOS and notify-send on linux, otherwise
-    falls back to stdout."""
+    Notifications are shown by a :class:`NotificationBackend`. By default, the first
+    available registered backend is used: D-Bus, AppleScript on macOS and notify-send
+    on linux, otherwise falls back to stdout. Pass a backend name, see
+    :func:`register_backend`, or a backend instance to choose a different one.
+
+    By default, notifications are delivered from a background thread so that
+    :meth:`send` never blocks. At most *max_queue* notifications wait for delivery,
+    identical waiting notifications are only queued once. When the queue is full, the
+    *overflow* policy applies: ``drop_newest`` discards the new notification,
+    ``drop_oldest`` discards the oldest waiting one and ``merge`` appends the message
+    to a waiting notification with the same title, dropping the oldest one if there is
+    none. The number of discarded notifications is kept in :attr:`dropped`.
+
+    At most *rate_limit* notifications with the same title are shown within
+    *rate_window* sec. Further notifications are suppressed and summarized in a single
+    notification at the end of the window, e.g., "12 more messages in the last 30 s".
+    The total number of suppressed notifications is kept in :attr:`suppressed`. Set
+    *rate_limit* to ``None`` to disable rate limiting."""
 
     enabled = True
 
-    def __init__(self):
-        self.implementation = self.__get_available_implementation()
+    def __init__(self, asynchronous=True, max_queue=20, overflow=OverflowPolicy.merge,
+                 timeout=10, rate_limit=5, rate_window=30, backend=None):
+        if backend is None:
+            backend = get_default_backend()(timeout=timeout)
+        elif isinstance(backend, str):
+            backend = get_backend(backend)(timeout=timeout)
+
+        self.backend = backend
+        self.implementation = backend.implementation
+
+        self.asynchronous = asynchronous
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.dropped = 0
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.suppressed = 0
+
+        self._rates = {}
+        self._rate_lock = threading.Lock()
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._busy = False
 
     def send(self, message, title="CustomXepr"):
         if self.enabled:
-            self.__send_message(message, title)
+            if self.rate_limit is None or self.__admit(message, title):
+                self.__deliver(message, title)
         else:
             pass
 
-    def __send_message(self, message, title=""):
-        if self.implementation == SupportedImplementation.osascript:
-            os.system("osascript -e 'display notification \"{}\" with title \"{}\"'".format(
-                message, title))
-        elif self.implementation == SupportedImplementation.notify_send:
-            os.system('notify-send "{}" "{}"'.format(title, message))
+    def join(self, timeout=None):
+        """Waits until all queued notifications have been delivered.
+
+        :param float timeout: Timeout in sec.
+        :returns: ``True`` if all notifications have been delivered, ``False`` on
+            timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._busy, timeout)
+
+    def __deliver(self, message, title):
+        if self.asynchronous:
+            self.__enqueue(message, title)
         else:
-            print('{}: {}'.format(title, message))
+            self.__send_message(message, title)
 
-    @staticmethod
-    def __command_exists(command):
-        return any(
-            os.access(os.path.join(path, command), os.X_OK)
-            for path in os.environ["PATH"].split(os.pathsep)
-        )
-
-    def __get_available_implementation(self):
-        if self.__command_exists('osascript'):
-            return SupportedImplementation.osascript
-        elif self.__command_exists('notify-send'):
-            return SupportedImplementation.notify_send
-        return None
+    def __admit(self, message, title):
+        # returns True if the notification may be shown now, otherwise it is
+        # counted towards the summary at the end of the rate window
+        now = time.monotonic()
+
+        with self._rate_lock:
+            rate = self._rates.get(title)
+            if rate is None:
+                self.__prune_rates(now)
+                rate = self._rates[title] = _TitleRate()
+
+            while rate.times and now - rate.times[0] >= self.rate_window:
+                rate.times.popleft()
+
+            if len(rate.times) < self.rate_limit:
+                rate.times.append(now)
+                return True
+
+            rate.suppressed += 1
+            rate.last_message = message
+            self.suppressed += 1
+
+            if rate.timer is None:
+                delay = rate.times[0] + self.rate_window - now
+                rate.timer = threading.Timer(delay, self.__send_summary, args=(title,))
+                rate.timer.daemon = True
+                rate.timer.start()
+
+            return False
+
+    def __prune_rates(self, now, max_titles=256):
+        if len(self._rates) >= max_titles:
+            for title, rate in list(self._rates.items()):
+                if rate.timer is None and all(now - t >= self.rate_window for t in rate.times):
+                    del self._rates[title]
+
+    def __send_summary(self, title):
+        with self._rate_lock:
+            rate = self._rates[title]
+            count, message = rate.suppressed, rate.last_message
+            rate.suppressed = 0
+            rate.last_message = None
+            rate.timer = None
+            rate.times.append(time.monotonic())
+
+        if count > 1:
+            message = '{} more messages in the last {:g} s, latest: {}'.format(
+                count, self.rate_window, message)
+
+        self.__deliver(message, title)
+
+    def __enqueue(self, message, title):
+        with self._cond:
+            entry = [title, message]
+
+            if entry in self._queue:
+                return
+
+            if len(self._queue) >= self.max_queue and not self.__make_room(entry):
+                return
+
+            self._queue.append(entry)
+            self._cond.notify_all()
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.__run, name='Notipy')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def __make_room(self, entry):
+        # returns True if the entry should still be queued
+        if self.overflow == OverflowPolicy.merge:
+            for queued in reversed(self._queue):
+                if queued[0] == entry[0]:
+                    if entry[1] not in queued[1].split('\n'):
+                        queued[1] += '\n' + entry[1]
+                    return False
+        elif self.overflow == OverflowPolicy.drop_newest:
+            self.dropped += 1
+            return False
+
+        self._queue.popleft()
+        self.dropped += 1
+        return True
+
+    def __run(self, idle_timeout=30):
+        while True:
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+                if not self._cond.wait_for(lambda: self._queue, idle_timeout):
+                    self._thread = None
+                    return
+
+                title, message = self._queue.popleft()
+                self._busy = True
+
+            self.__send_message(message, title)
+
+    def __send_message(self, message, title=""):
+        try:
+            self.backend.send(message, title)
+        except Exception:
+            logger.exception('Could not send notification')
@@ -7,13 +7,100 @@
 Attribution-NonCommercial-NoDerivs 2.0 UK: England & Wales License.
 
 """
+import collections
 
 # external packages
-from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5 import QtCore, QtGui, QtWidgets, sip
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPainter
+from PyQt5.QtGui import QPainter, QPixmap
 
-from .dark_mode_support import isDarkWindow
+from .dark_mode_support import isDarkWindow, ThemeMonitor
+from .frame_profiler import FrameProfiler
+
+
+class _AnimationClock(QtCore.QObject):
+    """
+    A process-wide animation clock. All progress indicators which share the same
+    animation delay are advanced from a single timer and their repaints are scheduled
+    in one batch. The clock stops itself when none of its indicators is visible, e.g.,
+    because they are hidden or their window is minimized.
+    """
+
+    _instances = {}
+
+    def __init__(self, delay):
+        QtCore.QObject.__init__(self, QtCore.QCoreApplication.instance())
+
+        self.m_indicators = []
+        self.m_windows = []
+        self.m_timer = QtCore.QTimer(self)
+        self.m_timer.setInterval(int(delay))
+        self.m_timer.timeout.connect(self.tick)
+
+    @classmethod
+    def instance(cls, delay):
+        delay = int(delay)
+        try:
+            return cls._instances[delay]
+        except KeyError:
+            clock = cls(delay)
+            cls._instances[delay] = clock
+            return clock
+
+    def register(self, indicator):
+        if indicator not in self.m_indicators:
+            self.m_indicators.append(indicator)
+        self.watchWindow(indicator)
+        self.reschedule()
+
+    def unregister(self, indicator):
+        if indicator in self.m_indicators:
+            self.m_indicators.remove(indicator)
+        self.reschedule()
+
+    def watchWindow(self, indicator):
+        # get notified when the top-level window is minimized or restored
+        window = indicator.window()
+        if window is not indicator and window not in self.m_windows:
+            self.m_windows.append(window)
+            window.installEventFilter(self)
+
+    def purge(self):
+        # indicators may be deleted by Qt without ever stopping their animation
+        self.m_indicators = [i for i in self.m_indicators if not sip.isdeleted(i)]
+        self.m_windows = [w for w in self.m_windows if not sip.isdeleted(w)]
+
+    @staticmethod
+    def isLive(indicator):
+        return indicator.isVisible() and not indicator.window().isMinimized()
+
+    def liveIndicators(self):
+        self.purge()
+        return [i for i in self.m_indicators if self.isLive(i)]
+
+    def reschedule(self):
+        if self.liveIndicators():
+            if not self.m_timer.isActive():
+                self.m_timer.start()
+        else:
+            self.m_timer.stop()
+
+    @QtCore.pyqtSlot()
+    def tick(self):
+        live = self.liveIndicators()
+
+        if not live:
+            self.m_timer.stop()
+            return
+
+        for indicator in live:
+            indicator.advance()
+
+    def eventFilter(self, obj, event):
+        if event.type() in (QtCore.QEvent.WindowStateChange, QtCore.QEvent.Show,
+                            QtCore.QEvent.Hide):
+            self.reschedule()
+        return False
 
 
 class QProgressIndicator(QtWidgets.QWidget):
@@ -23,25 +110,31 @@ class QProgressIndicator(QtWidgets.QWidget):
     """
 
     m_angle = None
-    m_timerId = None
+    m_clock = None
     m_delay = None
     m_displayedWhenStopped = None
     m_color = None
     m_light_color = QtGui.QColor(170, 170, 170)
     m_dark_color = QtGui.QColor(40, 40, 40)
 
+    # pre-rendered animation frames, keyed by (size, color, pixel ratio, animated), in
+    # least recently used order
+    _frame_cache = collections.OrderedDict()
+    _max_cached_frames = 16
+
     def __init__(self, parent=None):
         # Call parent class constructor first
         super(QProgressIndicator, self).__init__(parent)
 
         # Initialize instance variables
         self.m_angle = 0
-        self.m_timerId = -1
+        self.m_clock = None
         self.m_delay = 5/60*1000
         self.m_displayedWhenStopped = False
         self.m_color = self.m_dark_color
 
-        self.update_dark_mode()
+        self._apply_theme_color()
+        ThemeMonitor.instance().themeChanged.connect(self.update_dark_mode)
 
         # Set size and focus policy
         self.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
@@ -51,7 +144,7 @@ class QProgressIndicator(QtWidgets.QWidget):
         return self.m_delay
 
     def isAnimated(self):
-        return self.m_timerId != -1
+        return self.m_clock is not None
 
     def isDisplayedWhenStopped(self):
         return self.m_displayedWhenStopped
@@ -65,24 +158,28 @@ class QProgressIndicator(QtWidgets.QWidget):
     def startAnimation(self):
         self.m_angle = 0
 
-        if self.m_timerId == -1:
-            self.m_timerId = self.startTimer(int(self.m_delay))
+        if self.m_clock is None:
+            self.m_clock = _AnimationClock.instance(self.m_delay)
+            self.m_clock.register(self)
+            FrameProfiler.instance().startAnimation(self, interval=self.m_delay)
 
     def stopAnimation(self):
-        if self.m_timerId != -1:
-            self.killTimer(self.m_timerId)
+        if self.m_clock is not None:
+            self.m_clock.unregister(self)
+            FrameProfiler.instance().finishAnimation(self)
 
-        self.m_timerId = -1
+        self.m_clock = None
         self.update()
 
     def setAnimationDelay(self, delay):
-        if self.m_timerId != -1:
-            self.killTimer(self.m_timerId)
+        if self.m_clock is not None:
+            self.m_clock.unregister(self)
 
         self.m_delay = delay
 
-        if self.m_timerId != -1:
-            self.m_timerId = self.startTimer(self.m_delay)
+        if self.m_clock is not None:
+            self.m_clock = _AnimationClock.instance(self.m_delay)
+            self.m_clock.register(self)
 
     def setDisplayedWhenStopped(self, state):
         self.m_displayedWhenStopped = state
@@ -92,18 +189,67 @@ class QProgressIndicator(QtWidgets.QWidget):
         self.m_color = color
         self.update()
 
-    def timerEvent(self, event):
+    def advance(self):
+        """Advances the animation by one step. Called by the shared animation clock."""
         self.m_angle = (self.m_angle + 30) % 360
         self.update()
+        FrameProfiler.instance().recordFrame(self)
+
+    def showEvent(self, event):
+        if self.m_clock is not None:
+            self.m_clock.register(self)
+
+    def hideEvent(self, event):
+        if self.m_clock is not None:
+            self.m_clock.reschedule()
 
     def paintEvent(self, event):
         if (not self.m_displayedWhenStopped) and (not self.isAnimated()):
             return
 
+        profiler = FrameProfiler.instance()
+        start = profiler.now() if profiler.enabled else None
+
         width = min(self.width(), self.height())
+        frame = self.frames()[(self.m_angle // 30) % 12]
 
         painter = QPainter(self)
+        painter.drawPixmap((self.width() - width) // 2, (self.height() - width) // 2,
+                           frame)
+        painter.end()
+
+        if start is not None:
+            profiler.recordPaint(self, start)
+
+    def frames(self):
+        """
+        Returns the twelve animation frames for the current size, color and device
+        pixel ratio. Frames are rendered once and shared between all indicators.
+        """
+        key = (min(self.width(), self.height()), self.m_color.rgba(),
+               self.devicePixelRatioF(), self.isAnimated())
+
+        try:
+            self._frame_cache.move_to_end(key)
+            return self._frame_cache[key]
+        except KeyError:
+            frames = [self._renderFrame(angle, *key) for angle in range(0, 360, 30)]
+            self._frame_cache[key] = frames
+            while len(self._frame_cache) > self._max_cached_frames:
+                self._frame_cache.popitem(last=False)
+            return frames
+
+    @staticmethod
+    def _renderFrame(angle, width, rgba, pr, animated):
+
+        pixmap = QPixmap(round(width * pr), round(width * pr))
+        pixmap.setDevicePixelRatio(pr)
+        pixmap.fill(Qt.transparent)
+
+        painter = QPainter(pixmap)
         painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.translate(width * 0.5, width * 0.5)
 
         outerRadius = (width - 1) * 0.5
         innerRadius = (width - 1) * 0.5 * 0.4375
@@ -111,31 +257,34 @@ class QProgressIndicator(QtWidgets.QWidget):
         capsuleHeight = outerRadius - innerRadius
         capsuleWidth  = width * 3/32
         capsuleRadius = capsuleWidth / 2
+        capsule = QtCore.QRectF(capsuleWidth * -0.5, (innerRadius + capsuleHeight) * -1,
+                                capsuleWidth, capsuleHeight)
 
-        for i in range(0, 12):
-            color = QtGui.QColor(self.m_color)
+        color = QtGui.QColor.fromRgba(rgba)
 
-            if self.isAnimated():
+        for i in range(0, 12):
+            if animated:
                 color.setAlphaF(1.0 - (i / 12.0))
             else:
                 color.setAlphaF(0.2)
 
-            painter.setPen(Qt.NoPen)
             painter.setBrush(color)
             painter.save()
-            painter.translate(self.rect().center())
-            painter.rotate(self.m_angle - (i * 30.0))
-            painter.drawRoundedRect(capsuleWidth * -0.5,
-                                    (innerRadius + capsuleHeight) * -1, capsuleWidth,
-                                    capsuleHeight, capsuleRadius, capsuleRadius)
+            painter.rotate(angle - (i * 30.0))
+            painter.drawRoundedRect(capsule, capsuleRadius, capsuleRadius)
             painter.restore()
 
-    def changeEvent(self, QEvent):
+        painter.end()
 
-        if QEvent.type() == QtCore.QEvent.PaletteChange:
-            self.update_dark_mode()
+        return pixmap
 
+    @QtCore.pyqtSlot()
     def update_dark_mode(self):
+        # frames of the old theme will not be needed again
+        self._frame_cache.clear()
+        self._apply_theme_color()
+
+    def _apply_theme_color(self):
         if isDarkWindow():
             self.setColor(self.m_light_color)
         else:
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import pytest
+from PyQt5 import QtGui, QtWidgets
+
+from ..animated_widgets import AnimatedResizeWidget, AnimatedStackedWidget
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def test_loaded_page_is_not_evicted(app):
+    stack = AnimatedStackedWidget()
+    for _ in range(3):
+        stack.addLazyWidget(QtWidgets.QWidget)
+    stack.setMaxLoadedPages(1)
+
+    page = stack.loadPage(1)
+    assert stack.indexOf(page) == 1
+    assert stack.isPageLoaded(1)
+
+    stack.slideInIdx(2)
+    assert stack.isPageLoaded(2)
+    stack.m_animGroup.stop()
+    stack.animationDoneSlot()
+    assert stack.currentIndex() == 2
+
+
+def test_adjusted_size_follows_layout_changes(app):
+    widget = AnimatedResizeWidget()
+    layout = QtWidgets.QVBoxLayout(widget)
+    label = QtWidgets.QLabel("short")
+    layout.addWidget(label)
+
+    size = widget._adjustedSize()
+    assert widget._adjustedSize() == size
+
+    label.setText("a much longer text " * 5)
+    app.processEvents()
+
+    assert widget._adjustedSize().width() > size.width()
+
+    generation = widget._layoutGeneration
+    label.setFont(QtGui.QFont("Sans", 30))
+    widget.setStyleSheet("QLabel { padding: 20px; }")
+    app.processEvents()
+
+    assert widget._layoutGeneration > generation
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+from PyQt5 import QtCore, QtWidgets
+
+from ..misc import BackgroundTask, UserDialog, get_thread_pool
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def slow_target():
+    time.sleep(0.3)
+    return 42
+
+
+def test_pooled_task_outlives_deleted_parent(app):
+    parent = QtCore.QObject()
+    task = BackgroundTask(parent, target=slow_target, pool=get_thread_pool())
+    future = task.future
+
+    parent.deleteLater()
+    QtCore.QCoreApplication.sendPostedEvents(None, QtCore.QEvent.DeferredDelete)
+
+    assert get_thread_pool().waitForDone(5000)
+    app.processEvents()
+
+    assert future.result(timeout=0) == 42
+
+
+def test_pooled_dialog_drops_previous_handlers(app):
+    icon = app.style().standardIcon(QtWidgets.QStyle.SP_MessageBoxWarning)
+    calls = []
+
+    dialog = UserDialog.pooled(icon, "first", "message")
+    dialog.accepted.connect(lambda: calls.append("first"))
+    dialog.show()
+    dialog.accept()
+
+    recycled = UserDialog.pooled(icon, "second", "message")
+    assert recycled is dialog
+    recycled.show()
+    recycled.accept()
+
+    assert calls == ["first"]